@@ -0,0 +1,123 @@
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import numpy as np
+
+# Words that make a question lean on the previous turns ("what about it?", "is that enough?")
+REFERENTIAL_RE = re.compile(
+    r"\b(it|its|that|this|these|those|they|them|their|he|she|him|her|there|same|above|"
+    r"previous|earlier|mentioned|also|too|else|more|another)\b",
+    re.I
+)
+
+def is_standalone(question: str) -> bool:
+    """
+        Cheap check that a question can be understood without the chat history.
+    """
+    return not REFERENTIAL_RE.search(question)
+
+class SemanticAnswerCache:
+    """
+        Caches answers keyed on the embedding of the question.
+
+        A question is a hit when its cosine similarity with a cached question is at least
+        threshold. Entries are evicted least-recently-used once max_entries is reached and
+        expire after ttl seconds. A cache belongs to the engine of one index version: a new
+        version gets a new engine with an empty cache, so answers never outlive the
+        knowledge base they were generated from.
+
+        Attributes:
+            threshold (float) : minimum cosine similarity for a hit.
+            max_entries (int) : maximum number of cached answers.
+            ttl (float) : seconds an answer stays valid.
+            index_version (str) : the index version the answers are generated from, None for the legacy index.
+    """
+    def __init__(self, threshold: float = 0.95, max_entries: int = 1000, ttl: float = 86400,
+                 index_version: Optional[str] = None):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.index_version = index_version
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._matrix = None
+        self._keys: List[str] = []
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def invalidate(self):
+        """
+            Drops every cached answer.
+        """
+        if self._entries:
+            self.invalidations += 1
+        self._entries.clear()
+        self._matrix = None
+
+    def _evict_expired(self):
+        cutoff = time.monotonic() - self.ttl
+        expired = [key for key, entry in self._entries.items() if entry["created"] < cutoff]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def lookup(self, vector: List[float]) -> Optional[str]:
+        """
+            Returns the cached answer for the closest question, or None on a miss.
+        """
+        self._evict_expired()
+        if self._entries:
+            if self._matrix is None:
+                self._keys = list(self._entries)
+                self._matrix = np.stack([self._entries[key]["vector"] for key in self._keys])
+            scores = self._matrix @ _normalize(vector)
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                key = self._keys[best]
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]["answer"]
+        self.misses += 1
+        return None
+
+    def store(self, question: str, vector: List[float], answer: str):
+        """
+            Caches the answer to a question.
+        """
+        key = question.strip().lower()
+        self._entries[key] = {"vector": _normalize(vector), "answer": answer, "created": time.monotonic()}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._matrix = None
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations
+        }
+
+def _normalize(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def create_answer_cache(index_version: Optional[str]) -> Optional[SemanticAnswerCache]:
+    """
+        Builds the answer cache from the ANSWER_CACHE_* environment variables, or None if disabled.
+    """
+    if os.getenv("ANSWER_CACHE", "1") != "1":
+        return None
+    return SemanticAnswerCache(
+        threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+        max_entries=int(os.getenv("ANSWER_CACHE_SIZE", "1000")),
+        ttl=float(os.getenv("ANSWER_CACHE_TTL", "86400")),
+        index_version=index_version
+    )
@@ -0,0 +1,173 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+import numpy as np
+
+# A conversation mixing questions, follow-ups, small talk and shared contact details,
+# so every stage of a turn (router, cache, rewrite, extraction, fallback) gets exercised
+CONVERSATION = [
+    "Hi",
+    "What are the salary requirements for an Employment Pass?",
+    "How long does it take to process?",
+    "Can my spouse come with me on a Dependant's Pass?",
+    "My name is Alex Tan, alex.tan@example.com",
+    "How do I incorporate a private limited company in Singapore?",
+    "Do I need a local director for that?",
+    "When do I need to register for GST?",
+    "What is the difference between an S Pass and a Work Permit?",
+    "What documents are needed for an EntrePass application?",
+]
+
+def current_rss_mb() -> float:
+    """
+        Current resident set size, falling back to the peak where /proc isn't available.
+    """
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def configure(args, workdir: str):
+    """
+        Points the app at the fake llm and local SQLite files. Must run before bot_api is imported.
+    """
+    os.environ["LLM_PROVIDER"] = "fake"
+    os.environ["FAKE_LLM_FIRST_TOKEN_LATENCY"] = str(args.first_token_latency)
+    os.environ["FAKE_LLM_TOKEN_LATENCY"] = str(args.token_latency)
+    os.environ["FAKE_LLM_FALLBACK_RATE"] = str(args.fallback_rate)
+    os.environ["LEAD_STORE"] = "sqlite"
+    os.environ["LEAD_SQLITE_PATH"] = os.path.join(workdir, "leads.db")
+    os.environ["SESSION_BACKEND"] = args.session_backend
+    os.environ["SESSION_SQLITE_PATH"] = os.path.join(workdir, "sessions.db")
+    os.environ["INDEX_WATCH_INTERVAL"] = "0"
+    if args.no_cache:
+        os.environ["ANSWER_CACHE"] = "0"
+
+async def run_session(client, session_id: str, offset: int, turns: int, think_time: float,
+                      latencies: List[float], errors: List[str]):
+    for turn in range(turns):
+        message = CONVERSATION[(offset + turn) % len(CONVERSATION)]
+        start = time.perf_counter()
+        try:
+            response = await client.get(f"/chat/{session_id}", params={"message": message})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            errors.append(f"{session_id}#{turn}: {e!r}")
+        if think_time:
+            await asyncio.sleep(think_time)
+
+async def run(args) -> Dict:
+    import httpx
+    import bot_api
+    from metrics import metrics
+
+    await bot_api.startup()
+    transport = httpx.ASGITransport(app=bot_api.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        # One turn outside the measurement so lazy initialization isn't counted
+        await run_session(client, "warmup", 0, 1, 0, [], [])
+        metrics.stages.clear()
+        metrics.counters.clear()
+
+        latencies: List[float] = []
+        errors: List[str] = []
+        rss_before = current_rss_mb()
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            run_session(client, f"bench-{i}", i, args.turns, args.think_time, latencies, errors)
+            for i in range(args.sessions)
+        ])
+        elapsed = time.perf_counter() - start
+        rss_after = current_rss_mb()
+    snapshot = metrics.snapshot()
+    await bot_api.shutdown()
+
+    return {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "turns": len(latencies),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_turns_per_second": round(len(latencies) / elapsed, 3) if elapsed else None,
+        "latency_seconds": {
+            name: round(float(np.percentile(latencies, q)), 4) if latencies else None
+            for name, q in (("p50", 50), ("p95", 95), ("p99", 99), ("max", 100))
+        },
+        "rss_mb": {
+            "before": round(rss_before, 1),
+            "after": round(rss_after, 1),
+            "growth_per_session_kb": round((rss_after - rss_before) * 1024 / args.sessions, 2)
+        },
+        "stages": {
+            stage: {**values, "mean": round(values["sum"] / values["count"], 6) if values["count"] else None}
+            for stage, values in snapshot["stages"].items()
+        },
+        "counters": snapshot["counters"],
+        "gauges": snapshot["gauges"]
+    }
+
+def compare(result: Dict, baseline: Dict):
+    """
+        Prints the change of the headline numbers against a previous result file.
+    """
+    rows = [
+        ("p50", result["latency_seconds"]["p50"], baseline["latency_seconds"]["p50"]),
+        ("p95", result["latency_seconds"]["p95"], baseline["latency_seconds"]["p95"]),
+        ("p99", result["latency_seconds"]["p99"], baseline["latency_seconds"]["p99"]),
+        ("throughput", result["throughput_turns_per_second"], baseline["throughput_turns_per_second"]),
+        ("rss/session kb", result["rss_mb"]["growth_per_session_kb"], baseline["rss_mb"]["growth_per_session_kb"]),
+    ]
+    print(f"Compared with {baseline.get('commit')}:")
+    for name, new, old in rows:
+        change = f"{(new - old) / old:+.1%}" if new is not None and old else "n/a"
+        print(f"  {name:15s} {old} -> {new} ({change})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive bot_api's /chat with simulated sessions against a fake llm")
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=6)
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds between the turns of a session")
+    parser.add_argument("--first-token-latency", type=float, default=0.4)
+    parser.add_argument("--token-latency", type=float, default=0.01)
+    parser.add_argument("--fallback-rate", type=float, default=0.1)
+    parser.add_argument("--session-backend", default="memory", choices=["memory", "sqlite"])
+    parser.add_argument("--no-cache", action="store_true", help="disable the semantic answer cache")
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--compare", help="previous result file to compare with")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        configure(args, workdir)
+        result = asyncio.run(run(args))
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=1)
+    print(json.dumps({key: result[key] for key in ("turns", "errors", "throughput_turns_per_second", "latency_seconds", "rss_mb")}, indent=1))
+    print(f"Full results written to {args.out}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(result, json.load(f))
+    if result["errors"]:
+        sys.exit(1)
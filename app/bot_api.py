@@ -1,15 +1,27 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, Header, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
+from sse_starlette.sse import EventSourceResponse
 from typing import List, Dict, Optional
-from langchain_google_genai import ChatGoogleGenerativeAI
+import asyncio
+import hmac
+import json
 import os
 import uuid
 from datetime import datetime
 from dotenv import load_dotenv
 
 # Import your existing modules
-from rag_pipeline import load_vector_store, create_rag_chain
-from lead_capture import LeadInfo, LeadCapture
+from rag_pipeline import get_engine, lease_engine, reload_engine, watch_index
+from turn_pipeline import run_turn
+from conversation_memory import apply_summary, context_turns, new_memory, remember_turn, schedule_summary
+from lead_capture import LeadCapture, EXTRACTION_STATS
+from intent_router import ROUTER_STATS
+from fallback_predictor import fallback_stats
+from metrics import metrics, prefixed
+from persistence import get_lead_store
+from session_store import SessionStore
+from session_backends import create_session_backend
 
 # Load environment variables
 load_dotenv()
@@ -26,29 +38,90 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory session storage
-sessions = {}
+# Bounded in-memory session storage
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "3600"))
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "10000"))
+MAX_HISTORY = int(os.getenv("MAX_SESSION_HISTORY", "50"))
+RESTORE_EVICTED_SESSIONS = os.getenv("RESTORE_EVICTED_SESSIONS", "1") == "1"
 
-# Function for fallback responses
-async def fall_back(history: List[Dict], question: str, llm):
-    prompt = f"""
-        **Role**: You are the Fallback Specialist for InCorp Asia's chatbot. 
-        The main AI couldn't answer this query about our services.
+def new_session(lead_capture: LeadCapture, full_history: List[Dict] = None) -> Dict:
+    """Create the per-session state, the engine itself is shared"""
+    full_history = full_history or []
+    return {
+        # history (the verbatim window), unsummarized and summary, see conversation_memory
+        **new_memory([{"user": h["users"], "ai": h["ai"]} for h in full_history]),
+        "full_history": full_history,
+        "turns": len(full_history),
+        "lead_capture": lead_capture,
+        "created_at": datetime.now()
+    }
 
-        **Current Query That Needs Fallback**:
-        "{question}"
+async def restore_session(session_id: str) -> Optional[Dict]:
+    """Rebuild an evicted session from the lead row and transcript stored in Postgres"""
+    lead_store = get_lead_store()
+    # Make sure the latest turns of the session are written before reading them back. Only
+    # when it has queued writes, so an unknown session id costs a single lead lookup
+    if lead_store.has_pending(session_id):
+        await lead_store.flush()
+    lead = await lead_store.load_lead(session_id)
+    if lead is None:
+        return None
+    messages = await lead_store.load_transcript(session_id)
+    
+    lead_capture = LeadCapture(get_engine().llm)
+    lead_capture.lead_info, lead_capture.info_captured = lead
+    lead_capture.questions_asked = len(messages)
+    full_history = [{"users": m["user"], "ai": m["ai"]} for m in messages[-MAX_HISTORY:]]
+    session = new_session(lead_capture, full_history)
+    session["turns"] = len(messages)
+    # Fold the restored turns into a summary right away instead of sending them verbatim.
+    # Applied to the stored copy, external backends store the session once it's restored
+    schedule_summary(session_id, session, get_engine().llm,
+                     lambda summary, turns: store_summary(session_id, summary, turns))
+    return session
 
-        **Your Task**:
-        1. Provide a GENERAL but helpful response on the basis of the prompts provided.
-        2. Never say "according to your documents" or "in the context"
-        3. Just provide a good reply to the query dont respond with something staring with "Okay i understand".
- 
-        `Note: we donot have the service of connecting to specialists of the company so dont mention that`
+def forget_session(session_id: str, session: Optional[Dict]):
+    """Release the cached lead state of an evicted or expired session"""
+    get_lead_store().forget(session_id)
 
-        **Answer**:
-    """
-    response = await llm.ainvoke(prompt)
-    return response
+session_store = SessionStore(
+    max_sessions=MAX_SESSIONS,
+    idle_ttl=SESSION_IDLE_TTL,
+    max_history=MAX_HISTORY,
+    on_evict=forget_session,
+    on_restore=restore_session if RESTORE_EVICTED_SESSIONS else None
+)
+
+# SESSION_BACKEND=sqlite or postgres keeps sessions outside the process so any
+# uvicorn worker or replica can serve any turn, with the same restore and evict hooks
+sessions = create_session_backend(session_store, lambda: get_engine().llm)
+metrics.register_collector(lambda: prefixed("sessions", {
+    key: value for key, value in session_store.stats().items() if key != "evictions"
+}))
+
+async def evict_idle_sessions():
+    """Periodically drop idle sessions even when no new requests come in"""
+    while True:
+        await asyncio.sleep(min(SESSION_IDLE_TTL, 60))
+        try:
+            await sessions.evict_expired()
+        except Exception as e:
+            print(f"Session eviction failed: {e}")
+
+@app.on_event("startup")
+async def startup():
+    """Build the shared RAG engine once per process before serving traffic"""
+    await asyncio.to_thread(get_engine)
+    get_lead_store().start()
+    asyncio.create_task(evict_idle_sessions())
+    # Pick up newly published index versions without a restart
+    asyncio.create_task(watch_index())
+    asyncio.create_task(metrics.export_periodically())
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Flush pending lead writes before the worker exits"""
+    await get_lead_store().close()
 
 # Initialize session function
 async def init_session(session_id: str = None):
@@ -57,38 +130,83 @@ async def init_session(session_id: str = None):
     if not session_id:
         session_id = str(uuid.uuid4())
     
-    # Initialize the LLM
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-2.0-flash",
-        temperature=0.6,
-        google_api_key=os.getenv("GOOGLE_API_KEY")
-    )
+    # Sessions only hold their own state, the engine is shared
+    engine = get_engine()
+    session = new_session(LeadCapture(engine.llm))
+    await sessions.put(session_id, session)
     
-    # Load RAG chain
-    vector_db = load_vector_store()
-    rag_chain = create_rag_chain(vector_db)
-    
-    # Create session data structure
-    sessions[session_id] = {
-        "rag_chain": rag_chain,
-        "history": [],
-        "full_history": [],
-        "lead_capture": LeadCapture(llm),
-        "llm": llm,
-        "created_at": datetime.now()
-    }
-    
-    return session_id
+    return session_id, session
 
 # Get or create session
 async def get_or_create_session(session_id: str = None):
     """Get or create a session"""
-    if session_id and session_id in sessions:
-        return session_id
+    if session_id:
+        with metrics.span("session_load"):
+            session = await sessions.get(session_id)
+        if session is not None:
+            return session_id, session
     
     # Initialize new session
     return await init_session(session_id)
 
+async def store_summary(session_id: str, summary: str, turns: List[Dict]) -> bool:
+    """Merge a background summary update into the latest stored copy of the session"""
+    # The session may have had more turns meanwhile (on any worker), putting back the copy
+    # the update started from would drop them
+    session = await sessions.get(session_id)
+    if session is None or not apply_summary(session, summary, turns):
+        return False
+    await sessions.put(session_id, session)
+    return True
+
+async def store_late_extraction(session_id: str, lead_capture: LeadCapture):
+    """Store lead details found by an extraction that finished after its turn"""
+    # Later turns may have changed the stored session meanwhile, only the lead fields are merged
+    session = await sessions.get(session_id)
+    if session is None:
+        return
+    current = session["lead_capture"]
+    current.merge(lead_capture.lead_info)
+    get_lead_store().save_lead(session_id, current.lead_info, current.info_captured)
+    await sessions.put(session_id, session)
+
+async def process_turn(session_id: str, session: Dict, message: str):
+    """
+    Process one chat turn, yielding (event, text) tuples as the answer streams.
+    "token" events carry answer text, "reset" means discard the text sent so far.
+    The session history is updated once the answer is complete.
+    """
+    # Get session components
+    lead_capture = session["lead_capture"]
+    full_history = session["full_history"]
+    
+    # Stream the answer while lead info is extracted concurrently, the engine is leased
+    # so an index reload can't release it mid-turn
+    content = ""
+    with lease_engine() as engine:
+        llm = engine.llm
+        async for event, text in run_turn(engine, lead_capture, context_turns(session), message, session["summary"],
+                                          lambda: store_late_extraction(session_id, lead_capture)):
+            content = "" if event == "reset" else content + text
+            yield event, text
+    
+    # Store in the session history, the window only keeps the last turns verbatim
+    # and the older ones are summarized in the background
+    summary_due = remember_turn(session, message, content)
+    full_history.append({"users": message, "ai": content})
+    session_store.trim_history(session)
+    
+    # Persist the chat in the background
+    get_lead_store().save(
+        session_id, lead_capture.lead_info, lead_capture.info_captured,
+        session["turns"], message, content
+    )
+    session["turns"] += 1
+    with metrics.span("session_save"):
+        await sessions.put(session_id, session)
+    if summary_due:
+        schedule_summary(session_id, session, llm, lambda summary, turns: store_summary(session_id, summary, turns))
+
 @app.get("/chat/{session_id}")
 async def chat(
     session_id: Optional[str] = None, 
@@ -99,62 +217,98 @@ async def chat(
     Uses path parameter for session ID and query parameter for message
     """
     # Get or create session
-    session_id = await get_or_create_session(session_id)
-    session = sessions[session_id]
-    
-    # Get session components
-    lead_capture = session["lead_capture"]
-    history = session["history"]
-    full_history = session["full_history"]
-    rag_chain = session["rag_chain"]
-    llm = session["llm"]
-    
-    # Extract lead info from message (keeping this functionality)
-    await lead_capture.extract_info_from_message(message, history)
-    
-    # Increment question counter
-    lead_capture.increment_question()
+    session_id, session = await get_or_create_session(session_id)
     
-    # Format conversation history for context
-    chat_history = "\n".join([f"User: {h['user']}\nAI: {h['ai']}" for h in history])
-    full_query = f"Chat History:\n{chat_history}\n\nNew Question: {message}"
-    
-    # Get response from RAG chain
-    response = await rag_chain.ainvoke(full_query)
-    content = response.content
-
-    # Check if we should use fall back llm
-    if "<SERVICE_FALLBACK>" in content:
-        response = await fall_back(chat_history, message, llm)
-        content = response.content
-    
-    # Check if we should request lead info
-    if lead_capture.should_request_info():
-        content += lead_capture.get_info_request_message()
-    
-    # Store in the session history
-    history.append({"user": message, "ai": content})
-    full_history.append({"users": message, "ai": content})
-    
-    # Only keep the last 3 messages in immediate history (as in original code)
-    session["history"] = history[-3:]
+    content = ""
+    async for event, text in process_turn(session_id, session, message):
+        content = "" if event == "reset" else content + text
     
     return {
         "message": content,
         "session_id": session_id
     }
 
+@app.get("/chat/{session_id}/stream")
+async def chat_stream(
+    session_id: str,
+    message: str = Query(..., description="User message")
+):
+    """
+    Process a chat message and stream the response as Server-Sent Events.
+    Emits "token" events with answer text, a "reset" event if the text sent so far
+    must be discarded, and a final "done" event with the complete message.
+    """
+    # Get or create session
+    session_id, session = await get_or_create_session(session_id)
+
+    async def event_stream():
+        content = ""
+        async for event, text in process_turn(session_id, session, message):
+            content = "" if event == "reset" else content + text
+            yield {"event": event, "data": text}
+        yield {
+            "event": "done",
+            "data": json.dumps({"message": content, "session_id": session_id})
+        }
+
+    return EventSourceResponse(event_stream())
+
+@app.get("/chat/{session_id}/transcript")
+async def transcript(session_id: str):
+    """Return the stored transcript of a chat"""
+    messages = await get_lead_store().load_transcript(session_id)
+    if not messages:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    return {"session_id": session_id, "messages": messages}
+
 @app.get("/new-session")
 async def create_new_session():
     """Create a new chat session"""
-    session_id = await init_session()
+    session_id, _ = await init_session()
     return {"session_id": session_id}
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit rate of the semantic answer cache"""
+    cache = get_engine().answer_cache
+    return cache.stats() if cache is not None else {"enabled": False}
+
+@app.get("/sessions/stats")
+async def session_stats():
+    """Live session count and approximate memory held by the sessions"""
+    return await sessions.stats()
+
+@app.post("/admin/reload-index")
+async def reload_index(x_admin_token: Optional[str] = Header(None)):
+    """Switch to the latest published index version without restarting, needs ADMIN_TOKEN"""
+    admin_token = os.getenv("ADMIN_TOKEN")
+    # Without a token configured the endpoint stays off, watch_index still picks up new versions
+    if not admin_token:
+        raise HTTPException(status_code=503, detail="Index reload is disabled, set ADMIN_TOKEN")
+    if not hmac.compare_digest((x_admin_token or "").encode(), admin_token.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    reloaded = await reload_engine()
+    return {"reloaded": reloaded, "index_version": get_engine().version}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Per-stage latency histograms and counters in the Prometheus text format"""
+    return metrics.render_prometheus()
+
 @app.get("/healthcheck")
 async def healthcheck():
     """Simple health check endpoint"""
-    return {"status": "healthy"}
+    return {
+        "status": "healthy",
+        "engine_warmup_seconds": round(get_engine().warmup_seconds, 3),
+        "index_version": get_engine().version,
+        "lead_extraction": EXTRACTION_STATS,
+        "intent_router": ROUTER_STATS,
+        "fallback": fallback_stats()
+    }
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    # More than one worker needs SESSION_BACKEND=sqlite or postgres
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run("bot_api:app", host="0.0.0.0", port=8000, reload=workers == 1, workers=workers)
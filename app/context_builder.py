@@ -0,0 +1,99 @@
+import os
+from typing import List, Optional
+from langchain.schema import Document
+
+# Configuration
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1200"))  # Tokens of context per turn
+# A chunk that only came from the vector side needs at least this relevance (0-1)
+CONTEXT_MIN_RELEVANCE = float(os.getenv("CONTEXT_MIN_RELEVANCE", "0.25"))
+# A chunk that only came from the lexical side needs at least this BM25 score
+CONTEXT_MIN_BM25 = float(os.getenv("CONTEXT_MIN_BM25", "1.0"))
+MIN_OVERLAP = 50  # Shortest shared text treated as splitter overlap rather than coincidence
+MAX_OVERLAP = 400  # Longest overlap looked for, the splitter overlap is 200 characters
+
+_encoding = None
+
+def count_tokens(text: str) -> int:
+    """
+        Counts tokens with tiktoken's cl100k_base. Gemini's tokenizer differs, but the counts
+        are close enough to budget the prompt and compare turns.
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # The encoding file is downloaded on first use, estimate when that isn't possible
+            print(f"tiktoken unavailable ({e}), estimating tokens from characters")
+            _encoding = False
+    if _encoding is False:
+        return len(text) // 4
+    return len(_encoding.encode(text))
+
+def _overlap(first: str, second: str) -> int:
+    """
+        Length of the longest end of first that second starts with (the splitter overlap).
+    """
+    for size in range(min(len(first), len(second), MAX_OVERLAP), MIN_OVERLAP - 1, -1):
+        if first.endswith(second[:size]):
+            return size
+    return 0
+
+def _is_relevant(document: Document) -> bool:
+    vector_score = document.metadata.get("vector_score")
+    lexical_score = document.metadata.get("lexical_score")
+    if vector_score is None and lexical_score is None:
+        # Not scored by the hybrid retriever, nothing to filter on
+        return True
+    return (vector_score is not None and vector_score >= CONTEXT_MIN_RELEVANCE) or \
+        (lexical_score is not None and lexical_score >= CONTEXT_MIN_BM25)
+
+def _header(document: Document) -> str:
+    headers = [document.metadata.get(key) for key in ("Section", "Subsection")]
+    return " > ".join(header for header in headers if header)
+
+def build_context(documents: List[Document], budget: Optional[int] = None) -> str:
+    """
+        Turns the retrieved chunks into the {context} text of the prompt.
+
+        Chunks are taken best first. Weak candidates are dropped, duplicates are skipped
+        and the part of a chunk that repeats a neighbouring chunk (the splitter overlap)
+        is cut. Chunks are rendered as plain text under their Section > Subsection header
+        until the token budget is used up.
+
+        Args:
+            documents: the retrieved chunks, best first.
+            budget: maximum tokens of context, CONTEXT_TOKEN_BUDGET by default.
+    """
+    if budget is None:
+        budget = CONTEXT_TOKEN_BUDGET
+    selected: List[str] = []
+    blocks: List[str] = []
+    used = 0
+    for document in documents:
+        if not _is_relevant(document):
+            continue
+        text = document.page_content.strip()
+        if not text or any(text in kept for kept in selected):
+            continue
+        for kept in selected:
+            # Neighbouring chunks of the same section share up to 200 characters
+            text = text[_overlap(kept, text):]
+            cut = _overlap(text, kept)
+            if cut:
+                text = text[:-cut]
+        text = text.strip()
+        if len(text) < MIN_OVERLAP:
+            continue
+
+        header = _header(document)
+        block = f"[{header}]\n{text}" if header else text
+        tokens = count_tokens(block)
+        if used + tokens > budget:
+            # A shorter chunk further down may still fit
+            continue
+        selected.append(document.page_content.strip())
+        blocks.append(block)
+        used += tokens
+    return "\n\n".join(blocks)
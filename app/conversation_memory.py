@@ -0,0 +1,188 @@
+import asyncio
+import os
+import re
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+from context_builder import count_tokens
+from llm_gateway import OVERLOADED_ANSWER, with_priority
+from metrics import metrics
+
+# Configuration
+MEMORY_WINDOW = int(os.getenv("MEMORY_WINDOW", "3"))  # Turns kept verbatim in the prompt
+# How the turns that leave the window are folded into the summary: llm, or heuristic
+# which keeps the user's own messages. Both fit the summary into MEMORY_SUMMARY_TOKENS.
+MEMORY_SUMMARY = os.getenv("MEMORY_SUMMARY", "llm")
+MEMORY_SUMMARY_TOKENS = int(os.getenv("MEMORY_SUMMARY_TOKENS", "200"))
+
+# The lead info request appended by LeadCapture.get_info_request_message, a backticked
+# paragraph at the end of the answer
+INFO_REQUEST_RE = re.compile(r"\s*\n\n`[^`]*`\s*$")
+
+# Sessions whose summary is being updated, so a session never runs two updates at once
+_updating: Set[str] = set()
+_tasks: Set[asyncio.Task] = set()
+
+def strip_boilerplate(answer: str) -> str:
+    """
+        Removes what isn't part of the answer itself (the lead info request, the
+        overload apology) before a turn is kept as context.
+    """
+    answer = INFO_REQUEST_RE.sub("", answer)
+    return answer.replace(OVERLOADED_ANSWER, "").strip()
+
+def new_memory(turns: Optional[List[Dict]] = None) -> Dict:
+    """
+        The conversation memory of a session, as plain data so it can be stored with it.
+
+        history holds the last MEMORY_WINDOW turns verbatim, older turns wait in
+        unsummarized until the background update folds them into summary.
+
+        Args:
+            turns: earlier {"user", "ai"} turns, e.g. of a restored session.
+    """
+    memory = {"history": [], "unsummarized": [], "summary": ""}
+    for turn in turns or []:
+        remember_turn(memory, turn["user"], turn["ai"])
+    return memory
+
+def remember_turn(memory: Dict, message: str, answer: str) -> bool:
+    """
+        Adds a finished turn to the window, moving the oldest turns out of it.
+        Returns whether there are turns left to summarize.
+    """
+    memory["history"].append({"user": message, "ai": strip_boilerplate(answer)})
+    overflow = len(memory["history"]) - MEMORY_WINDOW
+    if overflow > 0:
+        memory["unsummarized"].extend(memory["history"][:overflow])
+        memory["history"] = memory["history"][overflow:]
+    return bool(memory["unsummarized"])
+
+def context_turns(memory: Dict) -> List[Dict]:
+    """
+        The turns that go to the prompt verbatim: the window, preceded by the turns whose
+        summary update hasn't finished yet so nothing is lost in between.
+    """
+    return memory["unsummarized"] + memory["history"]
+
+def format_summary(summary: str) -> str:
+    return f"Summary of the earlier conversation: {summary}\n" if summary else ""
+
+def _fit(lines: List[str], budget: int) -> List[str]:
+    # Drops the oldest lines until the summary is within budget
+    while len(lines) > 1 and count_tokens("\n".join(lines)) > budget:
+        lines = lines[1:]
+    return lines
+
+def summarize_heuristic(summary: str, turns: List[Dict], budget: int = MEMORY_SUMMARY_TOKENS) -> str:
+    """
+        Keeps what the user said, which is where facts like their nationality or salary are.
+    """
+    lines = summary.splitlines() if summary else []
+    # A single long message is cut to about half the budget (4 characters per token)
+    lines += [f"User said: {' '.join(turn['user'].split())[:budget * 2]}" for turn in turns]
+    return "\n".join(_fit(lines, budget))
+
+def summary_prompt(summary: str, turns: List[Dict], budget: int = MEMORY_SUMMARY_TOKENS) -> str:
+    formatted = "\n".join(f"User: {turn['user']}\nAI: {turn['ai']}" for turn in turns)
+    return f"""
+        Update the conversation summary with the new turns of a chat with InCorp Asia's assistant.
+        Keep every fact the user shared about themselves and their plans (nationality, job,
+        salary, family, company, pass or visa type, timelines) and the topics already answered.
+        Leave out names, emails and phone numbers. Use at most {budget * 3 // 4} words.
+        Return only the summary.
+
+        **Current summary**: {summary or "None"}
+
+        **New turns**:
+        {formatted}
+
+        **Updated summary**:
+    """
+
+async def summarize(summary: str, turns: List[Dict], llm=None, mode: str = MEMORY_SUMMARY,
+                    budget: int = MEMORY_SUMMARY_TOKENS) -> str:
+    """
+        Returns the summary with the turns folded in.
+
+        Args:
+            summary: the current summary.
+            turns: the turns to add to it.
+            llm: the chat model, only used in llm mode. It's called with the lowest priority.
+            mode: llm or heuristic.
+            budget: the most tokens the summary may have.
+    """
+    if mode == "llm" and llm is not None:
+        try:
+            response = await with_priority(llm, "summary").ainvoke(summary_prompt(summary, turns, budget))
+            updated = response.content.strip()
+            if updated and count_tokens(updated) <= budget * 2:
+                return "\n".join(_fit(updated.splitlines(), budget))
+        except Exception as e:
+            print(f"Summary update failed ({e!r}), using the heuristic")
+    return summarize_heuristic(summary, turns, budget)
+
+def apply_summary(memory: Dict, summary: str, turns: List[Dict]) -> bool:
+    """
+        Puts a finished summary update into the memory and removes the turns it folded in.
+        It's a compare-and-set: nothing changes unless those turns still lead unsummarized,
+        i.e. no other update (e.g. on another worker) got there first. Turns added meanwhile
+        wait for the next update. Returns whether the update was applied.
+    """
+    if not turns or memory["unsummarized"][:len(turns)] != turns:
+        return False
+    memory["summary"] = summary
+    memory["unsummarized"] = memory["unsummarized"][len(turns):]
+    return True
+
+async def update_summary(memory: Dict, llm=None,
+                         apply: Optional[Callable[[str, List[Dict]], Awaitable[bool]]] = None) -> bool:
+    """
+        Folds the unsummarized turns into the summary.
+
+        Args:
+            memory: the memory the turns and current summary are read from.
+            llm: the chat model used in llm mode.
+            apply: optional coroutine function(summary, turns) storing the result instead of
+                apply_summary on memory, e.g. into the latest stored copy of the session.
+
+        Returns whether the update was applied.
+    """
+    turns = list(memory["unsummarized"])
+    if not turns:
+        return False
+    with metrics.span("summary_update", turns=len(turns)):
+        summary = await summarize(memory["summary"], turns, llm)
+    applied = await apply(summary, turns) if apply is not None else apply_summary(memory, summary, turns)
+    metrics.inc("summary_updates" if applied else "summary_updates_discarded")
+    return applied
+
+def schedule_summary(key: str, memory: Dict, llm=None,
+                     apply: Optional[Callable[[str, List[Dict]], Awaitable[bool]]] = None):
+    """
+        Updates the summary in the background after the reply went out, at most one
+        update per session at a time in this process. Updates of the same session on
+        different workers may overlap, apply_summary then keeps the first and discards
+        the other.
+
+        Args:
+            key: identifies the session.
+            memory: the session's memory.
+            llm: the chat model used in llm mode.
+            apply: optional coroutine function(summary, turns) storing the result, see update_summary.
+                By default it's applied to memory itself.
+    """
+    if key in _updating:
+        return
+
+    async def run():
+        try:
+            await update_summary(memory, llm, apply)
+        except Exception as e:
+            print(f"Summary update for {key} failed: {e}")
+        finally:
+            _updating.discard(key)
+
+    _updating.add(key)
+    task = asyncio.create_task(run())
+    # Keep a reference so the task isn't garbage collected before it's done
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
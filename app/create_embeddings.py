@@ -1,59 +1,257 @@
 from langchain_community.vectorstores import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
 import os
-import torch
 import glob
+import hashlib
+import json
 from tqdm import tqdm
-from typing import List
+from typing import Dict, List, Tuple
 from langchain.schema import Document
 import shutil
+import index_versions
+from embeddings import EMBEDDING_BACKEND, EMBEDDING_MODEL, get_embeddings
+from lexical_index import LEXICAL_INDEX_FILE, build_lexical_index
+from mmap_store import VECTORS_FILE, export_mmap_store
+from topic_filter import TOPIC_INDEX_FILE, TOPIC_SCHEMA, build_topic_index
 
 # Configuration
-EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"  # Lightweight but effective
-PERSIST_DIR = "../incorp_db"  # Where Chroma will store data
-
-def get_embedding_device():
-    if torch.cuda.is_available():
-        return "cuda"
-    else:
-        return "cpu"
-
-def create_vector_db(documents: List[Document]):
-    """Creates and persists Chroma DB with embeddings"""
-    # 1. Initialize Embeddings
-    embeddings = HuggingFaceEmbeddings(
-        model_name=EMBEDDING_MODEL,
-        model_kwargs={"device": get_embedding_device()},
-        encode_kwargs={"normalize_embeddings": True}
-    )
+PERSIST_DIR = index_versions.INDEX_DIR  # Where Chroma will store data
+MANIFEST_FILE = "manifest.json"  # Hashes of what's in the index, kept inside the index dir
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))  # Chunks embedded and written per call
+
+def file_hash(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def chunk_ids(chunks: List[Document]) -> List[str]:
+    """
+        Stable chunk IDs: the source file, the Section/Subsection the chunk belongs to and
+        its position within that section. Editing one section doesn't renumber the others.
+    """
+    ids = []
+    seen: Dict[Tuple, int] = {}
+    for chunk in chunks:
+        key = (chunk.metadata["source"], chunk.metadata.get("Section", ""), chunk.metadata.get("Subsection", ""))
+        position = seen.get(key, 0)
+        seen[key] = position + 1
+        ids.append(hashlib.sha1("|".join([*key, str(position)]).encode()).hexdigest())
+    return ids
+
+def chunk_hash(chunk: Document) -> List[str]:
+    """
+        The hashes of a chunk's text and of its metadata, kept apart so a metadata-only
+        change (e.g. new topic tags) doesn't re-embed the chunk.
+    """
+    content = hashlib.sha256(chunk.page_content.encode()).hexdigest()
+    metadata = hashlib.sha256(json.dumps(chunk.metadata, sort_keys=True).encode()).hexdigest()
+    return [content, metadata]
+
+def update_metadatas(vector_db, ids: List[str], metadatas: List[Dict]):
+    """
+        Replaces the metadata of stored chunks without embedding them again. The langchain
+        wrapper has no call for that, so it goes to the Chroma collection directly.
+    """
+    collection = vector_db._collection
+    stored = collection.get(ids=ids, include=["metadatas"])
+    previous = dict(zip(stored["ids"], stored["metadatas"]))
+    # Chroma merges updated metadata into the stored one, keys that are gone (e.g. a topic
+    # the chunk no longer has) are removed by setting them to None
+    metadatas = [
+        {**{key: None for key in previous.get(chunk_id) or {} if key not in metadata}, **metadata}
+        for chunk_id, metadata in zip(ids, metadatas)
+    ]
+    collection.update(ids=ids, metadatas=metadatas)
+
+def load_manifest(persist_dir: str) -> Dict:
+    path = os.path.join(persist_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(manifest: Dict, persist_dir: str):
+    path = os.path.join(persist_dir, MANIFEST_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
+def update_vector_db(md_files: List[str], persist_dir: str):
+    """
+        Incrementally brings the Chroma DB in line with the markdown files.
+
+        Files whose hash matches the manifest are skipped without being parsed. Changed
+        files are re-chunked and only chunks that are new or whose content changed are
+        embedded; chunks and files that disappeared are deleted from the store.
+
+        Parsing runs in a process pool and chunks stream through fixed-size embedding
+        batches, so embedding memory depends on EMBED_BATCH_SIZE rather than the corpus
+        size. The derived indexes read the store in pages of STORE_PAGE_SIZE chunks and
+        the vectors go straight to disk, but every chunk's text and metadata is held while
+        the BM25 and mmap chunk files are written.
+
+        The BM25 lexical index, the topic index and the memory-mapped copy of the vectors
+        are rebuilt from the updated store whenever it changed. When the topics in
+        topic_filter change, every file is parsed again so its chunks get the new topic_*
+        metadata. Chunks whose text is unchanged only have their metadata updated in place,
+        without being embedded again.
+
+        Returns the vector store and a dict with the added, updated, retagged, deleted and
+        skipped counts.
+    """
+    from process_knowledgebase import iter_processed_docs
+
+    manifest = load_manifest(persist_dir)
+    same_model = (manifest.get("embedding_model"), manifest.get("embedding_backend")) == (EMBEDDING_MODEL, EMBEDDING_BACKEND)
+    if not same_model and os.path.isdir(persist_dir) and os.listdir(persist_dir):
+        # No manifest (legacy store) or a different model/backend: the stored vectors can't be reused
+        print("Manifest missing or embedding model changed, rebuilding the index")
+        shutil.rmtree(persist_dir)
+        manifest = {}
+    if manifest and manifest.get("topic_schema") != TOPIC_SCHEMA:
+        print("Topics changed, re-tagging every file")
+        for entry in manifest.get("files", {}).values():
+            entry["hash"] = None
+    manifest = {
+        "embedding_model": EMBEDDING_MODEL,
+        "embedding_backend": EMBEDDING_BACKEND,
+        "topic_schema": TOPIC_SCHEMA,
+        "files": manifest.get("files", {})
+    }
+
+    vector_db = Chroma(persist_directory=persist_dir, embedding_function=get_embeddings())
+    stats = {"added": 0, "updated": 0, "retagged": 0, "deleted": 0, "skipped": 0}
 
-    if os.path.exists(PERSIST_DIR):
-        shutil.rmtree(PERSIST_DIR)
+    # Only files whose content changed are parsed at all
+    changed_files = {}
+    for file_path in md_files:
+        digest = file_hash(file_path)
+        previous = manifest["files"].get(file_path)
+        if previous and previous["hash"] == digest:
+            stats["skipped"] += len(previous["chunks"])
+        else:
+            changed_files[file_path] = digest
 
-    
-    # 2. Create Vector Store
-    vector_db = Chroma.from_documents(
-        documents=documents,
-        embedding=embeddings,
-        persist_directory=PERSIST_DIR
+    batch_docs, batch_ids = [], []
+    retag_ids, retag_metadatas = [], []
+
+    def write_batches(final: bool = False):
+        # Chroma upserts by id, so new and changed chunks go through the same call
+        while len(batch_docs) >= EMBED_BATCH_SIZE or (final and batch_docs):
+            vector_db.add_documents(batch_docs[:EMBED_BATCH_SIZE], ids=batch_ids[:EMBED_BATCH_SIZE])
+            del batch_docs[:EMBED_BATCH_SIZE]
+            del batch_ids[:EMBED_BATCH_SIZE]
+        # Metadata-only changes keep their stored embeddings
+        while len(retag_ids) >= EMBED_BATCH_SIZE or (final and retag_ids):
+            update_metadatas(vector_db, retag_ids[:EMBED_BATCH_SIZE], retag_metadatas[:EMBED_BATCH_SIZE])
+            del retag_ids[:EMBED_BATCH_SIZE]
+            del retag_metadatas[:EMBED_BATCH_SIZE]
+
+    for file_path, chunks in tqdm(iter_processed_docs(list(changed_files)), total=len(changed_files)):
+        previous = manifest["files"].get(file_path, {"hash": None, "chunks": {}})
+        ids = chunk_ids(chunks)
+        hashes = [chunk_hash(chunk) for chunk in chunks]
+
+        for chunk, chunk_id, new_hash in zip(chunks, ids, hashes):
+            old = previous["chunks"].get(chunk_id)
+            if old == new_hash:
+                stats["skipped"] += 1
+                continue
+            # Same text, only the metadata changed: update it without embedding. A combined
+            # hash from a manifest written before the split is a string and re-embeds once
+            if isinstance(old, list) and old[0] == new_hash[0]:
+                stats["retagged"] += 1
+                retag_ids.append(chunk_id)
+                retag_metadatas.append(chunk.metadata)
+                continue
+            stats["updated" if old else "added"] += 1
+            batch_docs.append(chunk)
+            batch_ids.append(chunk_id)
+        write_batches()
+
+        current_ids = set(ids)
+        removed = [chunk_id for chunk_id in previous["chunks"] if chunk_id not in current_ids]
+        if removed:
+            vector_db.delete(ids=removed)
+            stats["deleted"] += len(removed)
+
+        manifest["files"][file_path] = {"hash": changed_files[file_path], "chunks": dict(zip(ids, hashes))}
+    write_batches(final=True)
+
+    # Files that are gone from the knowledge base
+    for file_path in set(manifest["files"]) - set(md_files):
+        removed = list(manifest["files"].pop(file_path)["chunks"])
+        if removed:
+            vector_db.delete(ids=removed)
+            stats["deleted"] += len(removed)
+
+    changed = stats["added"] or stats["updated"] or stats["retagged"] or stats["deleted"]
+    if changed or not os.path.exists(os.path.join(persist_dir, LEXICAL_INDEX_FILE)):
+        build_lexical_index(vector_db, persist_dir)
+    if changed or not os.path.exists(os.path.join(persist_dir, TOPIC_INDEX_FILE)):
+        build_topic_index(vector_db, persist_dir)
+    if changed or not os.path.exists(os.path.join(persist_dir, VECTORS_FILE)):
+        export_mmap_store(vector_db, persist_dir)
+    save_manifest(manifest, persist_dir)
+    print(
+        f"Vector DB updated at {os.path.abspath(persist_dir)}: "
+        f"{stats['added']} added, {stats['updated']} updated, {stats['retagged']} retagged, "
+        f"{stats['deleted']} deleted, {stats['skipped']} skipped"
     )
-    
-    # 3. Persist to disk
-    vector_db.persist()
-    print(f"Vector DB created at {os.path.abspath(PERSIST_DIR)}")
-    return vector_db
+    return vector_db, stats
+
+def index_is_current(md_files: List[str], persist_dir: str) -> bool:
+    """
+        Whether the index in persist_dir already matches the markdown files: same embedding
+        model and topics, the same files with the same hashes, and every derived index in place.
+        Only reads the manifest and hashes the files, nothing is loaded or copied.
+    """
+    manifest = load_manifest(persist_dir)
+    expected = (EMBEDDING_MODEL, EMBEDDING_BACKEND, TOPIC_SCHEMA)
+    if (manifest.get("embedding_model"), manifest.get("embedding_backend"), manifest.get("topic_schema")) != expected:
+        return False
+    files = manifest.get("files", {})
+    if set(files) != set(md_files):
+        return False
+    # Versions built before the lexical index, the mmap store or the topic index existed are
+    # republished with them
+    if not all(os.path.exists(os.path.join(persist_dir, name)) for name in (LEXICAL_INDEX_FILE, VECTORS_FILE, TOPIC_INDEX_FILE)):
+        return False
+    return all(files[file_path]["hash"] == file_hash(file_path) for file_path in md_files)
+
+def build_index_version(md_files: List[str]):
+    """
+        Builds a new index version next to the live one and publishes it atomically.
+
+        The files are first compared with the manifest of the live version. If nothing
+        changed, the live version stays published without copying it or loading the model.
+        Otherwise the current version is copied and updated incrementally, so running
+        servers keep reading an untouched directory until they switch to the new version.
+
+        Returns the vector store of the published version (None if it was kept) and the update stats.
+    """
+    current = index_versions.current_version()
+    current_dir = index_versions.version_dir(current)
+    if current is not None and index_is_current(md_files, current_dir):
+        chunks = sum(len(entry["chunks"]) for entry in load_manifest(current_dir)["files"].values())
+        print(f"Index unchanged, keeping version {current}")
+        return None, {"added": 0, "updated": 0, "retagged": 0, "deleted": 0, "skipped": chunks}
+
+    version = index_versions.new_version()
+    if os.path.exists(os.path.join(current_dir, MANIFEST_FILE)):
+        index_versions.copy_version(current, version)
+    vector_db, stats = update_vector_db(md_files, index_versions.version_dir(version))
+    index_versions.publish_version(version)
+    index_versions.prune_versions()
+    print(f"Published index version {version}")
+    return vector_db, stats
 
 if __name__ == "__main__":
-    # Connect with your previous code
-    from process_knowledgebase import process_immigration_doc 
-    md_files = glob.glob("../knowledge_base/*.md")
-    # Process all files and create DB
-    all_chunks = []
-    for file_path in tqdm(md_files):
-        all_chunks.extend(process_immigration_doc(file_path))
-    
-    db = create_vector_db(all_chunks)
-    
+    md_files = sorted(glob.glob("../knowledge_base/*.md"))
+    # Only new or changed chunks are embedded, into a new version published atomically
+    db, _ = build_index_version(md_files)
+    if db is None:
+        db = Chroma(persist_directory=index_versions.current_index_dir(), embedding_function=get_embeddings())
+
     # Test retrieval
     results = db.similarity_search("What are EP salary requirements?", k=3)
     for doc in results:
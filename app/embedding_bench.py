@@ -0,0 +1,131 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from typing import Dict, List
+import numpy as np
+
+# Representative questions, with the wording and abbreviations users actually send
+SAMPLE_QUERIES = [
+    "What are EP salary requirements?",
+    "How long does it take to get an Employment Pass approved?",
+    "Can I bring my spouse on a Dependant's Pass?",
+    "What is the difference between an S Pass and a Work Permit?",
+    "Do I need a local director to incorporate a company in Singapore?",
+    "How much does it cost to register a private limited company?",
+    "What documents are needed for an EntrePass application?",
+    "Can a foreigner open a corporate bank account remotely?",
+    "When do I need to register for GST?",
+    "What are the annual filing deadlines with ACRA?",
+    "How do I renew my Employment Pass?",
+    "Is a Personalised Employment Pass better than an EP?",
+]
+
+def load_corpus() -> List[str]:
+    """
+        Returns the chunk texts of the current index version.
+    """
+    from langchain_community.vectorstores import Chroma
+    from index_versions import current_index_dir
+
+    vector_db = Chroma(persist_directory=current_index_dir())
+    return vector_db.get(include=["documents"])["documents"]
+
+def top_k(embeddings, corpus: List[str], queries: List[str], k: int) -> List[List[int]]:
+    """
+        Exact cosine top-k over the corpus, so differences come from the embeddings alone.
+    """
+    docs = np.asarray(embeddings.embed_documents(corpus), dtype=np.float32)
+    docs /= np.clip(np.linalg.norm(docs, axis=1, keepdims=True), 1e-12, None)
+    results = []
+    for query in queries:
+        vector = np.asarray(embeddings.embed_query(query), dtype=np.float32)
+        scores = docs @ (vector / max(np.linalg.norm(vector), 1e-12))
+        results.append(np.argsort(-scores)[:k].tolist())
+    return results
+
+def check_overlap(backends: List[str], k: int, threshold: float) -> bool:
+    """
+        Compares each backend's retrieval top-k with the torch baseline.
+        Returns False if any backend's mean overlap drops below threshold.
+    """
+    from embeddings import get_embeddings
+
+    corpus = load_corpus()
+    if not corpus:
+        print("The current index is empty, build it with create_embeddings.py first")
+        return False
+    print(f"Top-{k} overlap against torch over {len(corpus)} chunks, {len(SAMPLE_QUERIES)} queries")
+
+    baseline = top_k(get_embeddings("torch"), corpus, SAMPLE_QUERIES, k)
+    passed = True
+    for backend in backends:
+        results = top_k(get_embeddings(backend), corpus, SAMPLE_QUERIES, k)
+        overlaps = [len(set(a) & set(b)) / k for a, b in zip(baseline, results)]
+        mean = float(np.mean(overlaps))
+        ok = mean >= threshold
+        passed = passed and ok
+        print(f"  {backend:10s} mean {mean:.3f}  min {min(overlaps):.3f}  {'OK' if ok else 'BELOW THRESHOLD'}")
+    return passed
+
+def _rss_mb() -> float:
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _bench_backend(backend: str, rounds: int, queue):
+    from embeddings import get_embeddings
+
+    start = time.perf_counter()
+    embeddings = get_embeddings(backend)
+    embeddings.embed_query("warmup")
+    load_seconds = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(rounds):
+        for query in SAMPLE_QUERIES:
+            start = time.perf_counter()
+            embeddings.embed_query(query)
+            latencies.append((time.perf_counter() - start) * 1000)
+    queue.put({
+        "backend": backend,
+        "load_seconds": round(load_seconds, 2),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 2),
+        "peak_rss_mb": round(_rss_mb(), 1),
+    })
+
+def benchmark(backends: List[str], rounds: int) -> List[Dict]:
+    """
+        Query-embedding latency and peak RSS per backend. Every backend runs in a fresh
+        process so the RSS isn't inflated by models (or torch) loaded by the others.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for backend in backends:
+        queue = context.Queue()
+        process = context.Process(target=_bench_backend, args=(backend, rounds, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the embedding backends")
+    parser.add_argument("--backends", default="torch,onnx,onnx-int8")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--threshold", type=float, default=float(os.getenv("EMBEDDING_OVERLAP_THRESHOLD", "0.8")))
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--skip-overlap", action="store_true")
+    args = parser.parse_args()
+    backends = args.backends.split(",")
+
+    for result in benchmark(backends, args.rounds):
+        print(json.dumps(result))
+
+    if not args.skip_overlap:
+        candidates = [backend for backend in backends if backend != "torch"]
+        if not check_overlap(candidates, args.k, args.threshold):
+            sys.exit(1)
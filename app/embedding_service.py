@@ -0,0 +1,139 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, List, Tuple
+from langchain_core.embeddings import Embeddings
+from metrics import metrics, prefixed
+
+# Configuration
+EMBED_SERVICE = os.getenv("EMBED_SERVICE", "1") == "1"  # 0 embeds every query on its own
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))  # How long a batch collects requests
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "32"))
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "4096"))  # Cached query embeddings
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64]
+
+def normalize_query(text: str) -> str:
+    # all-MiniLM-L6-v2 lowercases its input, so case and spacing don't change the embedding
+    return " ".join(text.lower().split())
+
+class BatchedEmbeddings(Embeddings):
+    """
+        Query embedding service shared by everything in the process that embeds queries.
+
+        Concurrent embed_query calls (from the retriever's worker threads, the answer cache
+        or aembed_query) are queued and collected for up to EMBED_BATCH_WAIT_MS, then run
+        as one embed_documents batch on a dedicated thread. Results are kept in a bounded
+        LRU keyed by the normalized text, so repeated questions are never embedded twice.
+        embed_documents (ingestion) goes straight to the wrapped model.
+
+        Attributes:
+            base (Embeddings) : the wrapped embedding model.
+            wait (float) : seconds a batch waits for more requests.
+            max_batch (int) : most queries embedded in one batch.
+            cache_size (int) : most query embeddings kept in the LRU.
+    """
+    def __init__(self, base: Embeddings, wait_ms: float = EMBED_BATCH_WAIT_MS,
+                 max_batch: int = EMBED_MAX_BATCH, cache_size: int = EMBED_CACHE_SIZE):
+        self.base = base
+        self.wait = wait_ms / 1000
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+        self._worker = None
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+        metrics.register_collector(lambda: prefixed("embedding", self.stats()))
+
+    def _cached(self, key: str):
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return vector
+
+    def _submit(self, text: str) -> Future:
+        future = Future()
+        key = normalize_query(text)
+        vector = self._cached(key)
+        if vector is not None:
+            future.set_result(vector)
+            return future
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+        self._queue.put((key, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._embed_batch(batch)
+
+    def _embed_batch(self, batch: List[Tuple[str, Future]]):
+        # The same question asked by several sessions at once is embedded once
+        texts = list(dict.fromkeys(key for key, _ in batch))
+        self.batches += 1
+        metrics.record("embedding_batch_size", len(texts), BATCH_SIZE_BUCKETS)
+        try:
+            with metrics.span("embedding_batch", size=len(texts)):
+                vectors = dict(zip(texts, self.base.embed_documents(texts)))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        with self._lock:
+            for text, vector in vectors.items():
+                self._cache[text] = vector
+                self._cache.move_to_end(text)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        for key, future in batch:
+            future.set_result(vectors[key])
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._submit(text).result()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await asyncio.wrap_future(self._submit(text))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.base.embed_documents(texts)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "cache_entries": len(self._cache),
+            "cache_hits": self.hits,
+            "cache_misses": self.misses,
+            "cache_hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "batches": self.batches,
+            "mean_requests_per_batch": round(self.misses / self.batches, 3) if self.batches else 0.0
+        }
+
+def create_query_embeddings(base: Embeddings) -> Embeddings:
+    """
+        Wraps an embedding model in the batching service, unless EMBED_SERVICE=0 or it already is.
+    """
+    if not EMBED_SERVICE or isinstance(base, BatchedEmbeddings):
+        return base
+    return BatchedEmbeddings(base)
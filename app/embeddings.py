@@ -0,0 +1,136 @@
+import os
+from typing import List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# Configuration
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+# torch (sentence-transformers), onnx, or onnx-int8 (dynamically quantized)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "../models/all-MiniLM-L6-v2-onnx")
+MAX_SEQ_LENGTH = 256  # Same truncation as the sentence-transformers model
+
+def get_embedding_device():
+    import torch
+    if torch.cuda.is_available():
+        return "cuda"
+    else:
+        return "cpu"
+
+class OnnxEmbeddings(Embeddings):
+    """
+        all-MiniLM-L6-v2 running on onnxruntime, without importing torch.
+
+        Reproduces the sentence-transformers pipeline: tokenize, run the transformer,
+        mean-pool over the attention mask and L2-normalize.
+
+        Attributes:
+            model_path (str) : the exported .onnx model.
+            tokenizer_path (str) : the tokenizer.json saved next to it.
+            batch_size (int) : texts per forward pass in embed_documents.
+    """
+    def __init__(self, model_path: str, tokenizer_path: str, batch_size: int = 32, normalize: bool = True):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.normalize = normalize
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length=MAX_SEQ_LENGTH)
+        self.tokenizer.enable_padding()
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+        token_embeddings = self.session.run(None, inputs)[0]
+
+        mask = attention_mask[..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.normalize:
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self._embed(texts[start:start + self.batch_size]).tolist())
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0].tolist()
+
+def onnx_model_path(quantized: bool) -> str:
+    return os.path.join(ONNX_MODEL_DIR, "model-int8.onnx" if quantized else "model.onnx")
+
+def export_onnx(quantize: bool = True):
+    """
+        Exports all-MiniLM-L6-v2 to ONNX_MODEL_DIR, plus an int8 dynamically quantized copy.
+        Needs torch and transformers, so run it once at build time, not in the servers.
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(ONNX_MODEL_DIR, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
+    model = AutoModel.from_pretrained(EMBEDDING_MODEL).eval()
+    tokenizer.save_pretrained(ONNX_MODEL_DIR)
+
+    sample = tokenizer(["warmup"], return_tensors="pt")
+    input_names = ["input_ids", "attention_mask", "token_type_ids"]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(sample[name] for name in input_names),
+            onnx_model_path(quantized=False),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=17
+        )
+    print(f"Exported {EMBEDDING_MODEL} to {onnx_model_path(quantized=False)}")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(onnx_model_path(quantized=False), onnx_model_path(quantized=True), weight_type=QuantType.QInt8)
+        print(f"Quantized model written to {onnx_model_path(quantized=True)}")
+
+def get_embeddings(backend: str = EMBEDDING_BACKEND, normalize: bool = True) -> Embeddings:
+    """
+        Returns the embedding model for the selected backend.
+
+        Both the servers and create_embeddings.py go through here so queries and documents
+        are always embedded the same way.
+    """
+    if backend in ("onnx", "onnx-int8"):
+        quantized = backend == "onnx-int8"
+        if not os.path.exists(onnx_model_path(quantized)):
+            print(f"{onnx_model_path(quantized)} not found, exporting it")
+            export_onnx(quantize=quantized)
+        return OnnxEmbeddings(
+            onnx_model_path(quantized),
+            os.path.join(ONNX_MODEL_DIR, "tokenizer.json"),
+            normalize=normalize
+        )
+    if backend != "torch":
+        raise ValueError(f"Unknown embedding backend: {backend}")
+
+    from langchain_huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL,
+        model_kwargs={"device": get_embedding_device()},
+        encode_kwargs={"normalize_embeddings": normalize}
+    )
+
+if __name__ == "__main__":
+    export_onnx()
@@ -0,0 +1,153 @@
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from langchain.schema import Document
+from lead_capture import EMAIL_RE, WEAK_NAME_RE, fast_extract
+from metrics import metrics, prefixed
+
+# What to do when the retrieval scores predict a <SERVICE_FALLBACK>:
+# off only logs the prediction, replace streams the fallback answer without calling
+# the RAG chain, race starts the fallback next to the RAG chain and cancels the loser.
+FALLBACK_MODE = os.getenv("FALLBACK_MODE", "off")
+# A turn is predicted to fall back when the best vector relevance of its chunks is below this
+FALLBACK_THRESHOLD = float(os.getenv("FALLBACK_THRESHOLD", "0.3"))
+# Turns are appended here as JSON lines for offline threshold evaluation, empty disables it.
+# Contact details in the questions are redacted.
+FALLBACK_LOG = os.getenv("FALLBACK_LOG", "")
+# One thread appends the log lines in order, off the event loop
+_log_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fallback-log")
+
+FALLBACK_STATS = {
+    "turns": 0,
+    "predicted": 0,
+    "fallbacks": 0,  # The RAG chain answered with the sentinel
+    "replaced": 0,  # The RAG chain was skipped
+    "race_won": 0,  # The early fallback was used
+    "race_cancelled": 0,  # The early fallback was cancelled because RAG answered
+    "sentinel_seconds": 0.0,  # Total time until the sentinel showed up, over the fallbacks
+    "latency_saved_seconds": 0.0
+}
+
+def retrieval_confidence(documents: List[Document]) -> float:
+    """
+        Best vector relevance among the retrieved chunks, 0 when none came from the vector side.
+    """
+    scores = [document.metadata.get("vector_score") for document in documents]
+    return max([score for score in scores if score is not None], default=0.0)
+
+def predicts_fallback(confidence: Optional[float], threshold: float = FALLBACK_THRESHOLD) -> bool:
+    return confidence is not None and confidence < threshold
+
+def mean_sentinel_seconds() -> float:
+    """
+        How long the RAG chain took on average to produce the sentinel, i.e. what replace saves.
+    """
+    if not FALLBACK_STATS["fallbacks"]:
+        return 0.0
+    return FALLBACK_STATS["sentinel_seconds"] / FALLBACK_STATS["fallbacks"]
+
+def redact(text: str) -> str:
+    """
+        Replaces the emails, phones and names found by the lead extraction with placeholders.
+    """
+    found, _ = fast_extract(text)
+    text = EMAIL_RE.sub("[email]", text)
+    for field in ("phone", "name"):
+        if field in found:
+            text = text.replace(found[field], f"[{field}]")
+    # "I'm X" is left to the llm by the extraction, it's redacted either way
+    return WEAK_NAME_RE.sub(lambda match: match.group(0)[:match.start(1) - match.start(0)] + "[name]", text)
+
+def _append_log(line: str):
+    try:
+        with open(FALLBACK_LOG, "a", encoding="utf-8") as f:
+            f.write(line)
+    except OSError as e:
+        print(f"Failed to log turn to {FALLBACK_LOG}: {e}")
+
+def record_turn(record: Dict):
+    """
+        Updates the counters for a finished turn and queues it, redacted, for FALLBACK_LOG.
+    """
+    FALLBACK_STATS["turns"] += 1
+    FALLBACK_STATS["predicted"] += record["predicted"]
+    outcome = record["outcome"]
+    if outcome == "replaced":
+        FALLBACK_STATS["replaced"] += 1
+        FALLBACK_STATS["latency_saved_seconds"] += mean_sentinel_seconds()
+    elif record["fell_back"]:
+        FALLBACK_STATS["fallbacks"] += 1
+        FALLBACK_STATS["sentinel_seconds"] += record["sentinel_seconds"]
+    if outcome == "race_won":
+        FALLBACK_STATS["race_won"] += 1
+        FALLBACK_STATS["latency_saved_seconds"] += record["head_start_seconds"]
+    elif outcome == "race_cancelled":
+        FALLBACK_STATS["race_cancelled"] += 1
+
+    if FALLBACK_LOG:
+        logged = {"time": time.time(), **record}
+        for field in ("question", "retrieval_query"):
+            if logged.get(field):
+                logged[field] = redact(logged[field])
+        _log_writer.submit(_append_log, json.dumps(logged) + "\n")
+
+def fallback_stats() -> Dict:
+    turns = FALLBACK_STATS["turns"]
+    return {
+        **FALLBACK_STATS,
+        "mode": FALLBACK_MODE,
+        "threshold": FALLBACK_THRESHOLD,
+        "fallback_rate": round((FALLBACK_STATS["fallbacks"] + FALLBACK_STATS["replaced"]) / turns, 4) if turns else 0.0,
+        "latency_saved_seconds": round(FALLBACK_STATS["latency_saved_seconds"], 3),
+        "sentinel_seconds": round(FALLBACK_STATS["sentinel_seconds"], 3)
+    }
+
+def _fallback_gauges() -> Dict:
+    return prefixed("fallback", {key: value for key, value in fallback_stats().items() if key != "mode"})
+
+metrics.register_collector(_fallback_gauges)
+
+def evaluate_thresholds(records: List[Dict], thresholds: List[float]) -> List[Dict]:
+    """
+        Scores each threshold against logged turns where the RAG chain ran to the end, so
+        whether it fell back is known. Reports precision and recall of the prediction, and
+        the latency replace would have saved (the sentinel time of correctly predicted
+        fallbacks) against how many real answers it would have thrown away.
+    """
+    labeled = [r for r in records if r.get("fell_back") is not None and r.get("confidence") is not None]
+    results = []
+    for threshold in thresholds:
+        tp = fp = fn = 0
+        saved = 0.0
+        for record in labeled:
+            predicted = predicts_fallback(record["confidence"], threshold)
+            if predicted and record["fell_back"]:
+                tp += 1
+                saved += record.get("sentinel_seconds") or 0.0
+            elif predicted:
+                fp += 1
+            elif record["fell_back"]:
+                fn += 1
+        results.append({
+            "threshold": threshold,
+            "precision": round(tp / (tp + fp), 3) if tp + fp else None,
+            "recall": round(tp / (tp + fn), 3) if tp + fn else None,
+            "lost_answers": fp,
+            "saved_seconds": round(saved, 2)
+        })
+    return results
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else FALLBACK_LOG
+    if not path:
+        sys.exit("Usage: python fallback_predictor.py <turn log> (or set FALLBACK_LOG)")
+    with open(path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    fell_back = [r for r in records if r.get("fell_back") is not None]
+    rate = sum(r["fell_back"] for r in fell_back) / len(fell_back) if fell_back else 0.0
+    print(f"{len(records)} turns, {len(fell_back)} with a known outcome, fallback rate {rate:.1%}")
+    for result in evaluate_thresholds(records, [round(0.05 * step, 2) for step in range(1, 13)]):
+        print(json.dumps(result))
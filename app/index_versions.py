@@ -0,0 +1,86 @@
+import os
+import shutil
+import time
+from typing import Optional
+
+# Every index build goes into its own directory under INDEX_DIR/versions and is
+# published by atomically rewriting INDEX_DIR/CURRENT. Servers never see a
+# half-written index and can switch to a new one without restarting.
+INDEX_DIR = "../incorp_db"
+VERSIONS_DIR = os.path.join(INDEX_DIR, "versions")
+CURRENT_FILE = os.path.join(INDEX_DIR, "CURRENT")
+KEEP_VERSIONS = int(os.getenv("INDEX_KEEP_VERSIONS", "3"))
+
+def current_version() -> Optional[str]:
+    """
+        Returns the published index version, or None for a legacy unversioned index.
+    """
+    try:
+        with open(CURRENT_FILE, "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def version_dir(version: Optional[str]) -> str:
+    """
+        Returns the directory of an index version. None is the legacy index living directly in INDEX_DIR.
+    """
+    return os.path.join(VERSIONS_DIR, version) if version else INDEX_DIR
+
+def current_index_dir() -> str:
+    return version_dir(current_version())
+
+def new_version() -> str:
+    """
+        Creates and returns a fresh, empty version directory name.
+    """
+    version = time.strftime("%Y%m%d-%H%M%S")
+    suffix = 0
+    while os.path.exists(version_dir(f"{version}-{suffix}")):
+        suffix += 1
+    version = f"{version}-{suffix}"
+    os.makedirs(version_dir(version))
+    return version
+
+def copy_version(source: Optional[str], target: str):
+    """
+        Seeds a new version with a copy of an existing one so it can be updated incrementally.
+    """
+    source_dir = version_dir(source)
+    target_dir = version_dir(target)
+    for name in os.listdir(source_dir):
+        # The legacy index dir also holds the pointer and the other versions
+        if source is None and name in ("versions", "CURRENT", "CURRENT.tmp"):
+            continue
+        path = os.path.join(source_dir, name)
+        if os.path.isdir(path):
+            shutil.copytree(path, os.path.join(target_dir, name))
+        else:
+            shutil.copy2(path, target_dir)
+
+def publish_version(version: str):
+    """
+        Atomically points CURRENT at a fully built version.
+    """
+    tmp_path = f"{CURRENT_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, CURRENT_FILE)
+
+def discard_version(version: str):
+    shutil.rmtree(version_dir(version), ignore_errors=True)
+
+def prune_versions(keep: int = KEEP_VERSIONS):
+    """
+        Deletes all but the newest keep versions. The current version is never deleted.
+        Older versions are kept for a while so servers finishing turns on them aren't disturbed.
+    """
+    if not os.path.isdir(VERSIONS_DIR):
+        return
+    current = current_version()
+    versions = sorted(os.listdir(VERSIONS_DIR), reverse=True)
+    for version in versions[keep:]:
+        if version != current:
+            discard_version(version)
@@ -0,0 +1,158 @@
+import json
+import os
+import re
+import sys
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from lead_capture import EMAIL_RE, fast_extract
+from metrics import metrics, prefixed
+
+# Answers the decision-tree cases 1, 2, 3 and 5 of the RAG prompt locally, so those
+# turns skip the embedding, the retrieval and the llm call. Rules only fire when they
+# are sure, anything else is a "service" question and goes to the RAG chain.
+INTENT_ROUTER = os.getenv("INTENT_ROUTER", "1") == "1"
+INTENT_SAMPLES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_samples.jsonl")
+
+INTENTS = ["service", "jobs", "personal_info", "unrelated", "greeting"]
+CANNED_ANSWERS = {
+    "jobs": "We currently don't have job openings at InCorp Asia.",
+    "personal_info": "Thank you for sharing your details!",
+    "unrelated": "I'm sorry, I can't assist with this as it's unrelated to our services.",
+    "greeting": "Hello! Welcome to InCorp Asia. How can I help you with immigration, incorporation, tax or compliance today?",
+}
+
+GREETING_WORDS = {"hi", "hello", "hey", "hiya", "howdy", "greetings", "morning", "afternoon", "evening"}
+GREETING_FILLER = {"good", "there", "all", "team", "incorp", "asia", "bot", "how", "are", "you", "doing", "is", "it", "going"}
+JOBS_RE = re.compile(
+    r"\b(job (openings?|vacanc\w*|opportunit\w*)|vacanc(y|ies) (at|in|with) (incorp|your)|"
+    r"(are|is) (you|incorp\w*)( \w+)? hiring|any (job )?(openings|vacancies)|"
+    r"(careers?|jobs?|internships?|work) (at|with|for) (incorp|you\b|your company)|"
+    r"join (incorp|your (team|company)))",
+    re.I
+)
+OFFTOPIC_RE = re.compile(
+    r"\b(weather|recipes?|cook(ing)?|movies?|songs?|lyrics|football|cricket|soccer|jokes?|poems?|"
+    r"restaurants?|hotels?|flights?|air ?tickets?|sightseeing|tourist spots?|homework|"
+    r"write (some |a )?code|python|javascript|bitcoin price|stock tips)\b",
+    re.I
+)
+# Anything touching our services goes to the RAG chain even if it also looks off-topic or
+# like a job query. "Singapore" alone doesn't count, it's in most off-topic questions too.
+SERVICE_RE = re.compile(
+    r"\b(visas?|pass(es)?|permits?|immigration|pr|citizenship|company|companies|incorporat\w*|"
+    r"business\w*|tax\w*|gst|acra|compliance|accounting|account|director\w*|registration|"
+    r"register\w*|licen[cs]e\w*|employ\w*|payroll|audit\w*|corporate|secretary|"
+    r"ep|dp|ltvp|pep|entrepass|compass|onepass|iras|cpf)\b",
+    re.I
+)
+
+# A message sharing contact details that also asks for something goes to the RAG chain
+REQUEST_RE = re.compile(r"\b(how|what|when|where|why|which|need|needs|help|tell me|explain|looking for|requirements?)\b", re.I)
+
+# Router decisions since startup
+ROUTER_STATS = Counter()
+metrics.register_collector(lambda: prefixed("router", ROUTER_STATS))
+
+def _is_greeting(message: str) -> bool:
+    words = re.findall(r"[a-z]+", message.lower())
+    if not words or len(words) > 6 or "?" in message and "how" not in words:
+        return False
+    if words[:3] == ["how", "are", "you"]:
+        return len(words) <= 4
+    return bool(GREETING_WORDS & set(words)) and all(w in GREETING_WORDS | GREETING_FILLER for w in words)
+
+def _is_personal_info(message: str) -> bool:
+    """
+        A message that only shares contact details, questions or requests alongside them
+        ("my email is ..., tell me the PR requirements") go to the RAG chain.
+    """
+    found, _ = fast_extract(message)
+    if not found or "?" in message:
+        return False
+    rest = EMAIL_RE.sub(" ", message)
+    for field in ("phone", "name"):
+        if field in found:
+            rest = rest.replace(found[field], " ")
+    if SERVICE_RE.search(rest) or REQUEST_RE.search(rest):
+        return False
+    return len(re.findall(r"\w+", rest)) <= 12
+
+def classify(message: str) -> Tuple[str, str]:
+    """
+        Returns the intent of a message and the rule that decided it.
+    """
+    if _is_greeting(message):
+        return "greeting", "greeting words only"
+    if _is_personal_info(message):
+        return "personal_info", "contact details only"
+    jobs = JOBS_RE.search(message)
+    # "work for your company on a dependant pass" is a service question, only what's left
+    # around the job phrase is checked since the phrase itself may say "your company"
+    if jobs and not SERVICE_RE.search(message[:jobs.start()] + " " + message[jobs.end():]):
+        return "jobs", f"jobs: {jobs.group()}"
+    offtopic = OFFTOPIC_RE.search(message)
+    if offtopic and not SERVICE_RE.search(message):
+        return "unrelated", f"off-topic: {offtopic.group()}"
+    return "service", "default"
+
+def route(message: str) -> Optional[str]:
+    """
+        Returns the canned answer for a message the RAG chain doesn't need to see, else None.
+    """
+    if not INTENT_ROUTER:
+        return None
+    intent, reason = classify(message)
+    ROUTER_STATS[intent] += 1
+    if intent == "service":
+        return None
+    print(f"Router: {intent} ({reason})")
+    return CANNED_ANSWERS[intent]
+
+def load_samples(path: str = INTENT_SAMPLES_FILE) -> List[Dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def evaluate(samples: List[Dict]) -> Dict:
+    """
+        Classifies labeled samples and returns the confusion matrix, per-intent precision and
+        recall, and the misrouted service questions (the costly mistake: a canned reply to a real question).
+    """
+    matrix = {label: Counter() for label in INTENTS}
+    misrouted = []
+    for sample in samples:
+        predicted, reason = classify(sample["text"])
+        matrix[sample["intent"]][predicted] += 1
+        if predicted != sample["intent"]:
+            misrouted.append({**sample, "predicted": predicted, "reason": reason})
+
+    report = {}
+    for label in INTENTS:
+        true_positives = matrix[label][label]
+        predicted = sum(matrix[actual][label] for actual in INTENTS)
+        actual = sum(matrix[label].values())
+        report[label] = {
+            "precision": round(true_positives / predicted, 3) if predicted else None,
+            "recall": round(true_positives / actual, 3) if actual else None,
+            "support": actual
+        }
+    return {"matrix": matrix, "report": report, "misrouted": misrouted}
+
+def print_evaluation(result: Dict):
+    width = max(len(label) for label in INTENTS) + 2
+    print("actual \\ predicted".ljust(width + 4) + "".join(label[:width].rjust(width) for label in INTENTS))
+    for actual in INTENTS:
+        row = "".join(str(result["matrix"][actual][predicted]).rjust(width) for predicted in INTENTS)
+        print(actual.ljust(width + 4) + row)
+    print()
+    for label, scores in result["report"].items():
+        print(f"{label:15s} precision {scores['precision']}  recall {scores['recall']}  support {scores['support']}")
+    for sample in result["misrouted"]:
+        print(f"  {sample['intent']} -> {sample['predicted']} ({sample['reason']}): {sample['text']}")
+
+if __name__ == "__main__":
+    result = evaluate(load_samples(sys.argv[1] if len(sys.argv) > 1 else INTENT_SAMPLES_FILE))
+    print_evaluation(result)
+    # A real question answered with a canned reply is worse than a canned case sent to RAG
+    service = result["report"]["service"]["recall"]
+    if service is not None and service < 1.0:
+        sys.exit(1)
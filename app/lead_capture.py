@@ -1,6 +1,81 @@
 import json
-from typing import List, Dict, Optional
+import re
+from typing import List, Dict, Optional, Tuple
 from pydantic import BaseModel
+from llm_gateway import with_priority
+from metrics import metrics, prefixed
+
+# Fast-path patterns used before falling back to the LLM
+EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+# A number only counts as a phone with a cue before it or in international format, on its
+# own it's as likely a salary range, a year range, a date or a passport number
+PHONE_NUMBER = r"(?:\+|00)?\(?\d[\d\s().-]{6,20}\d(?![\w%])"
+PHONE_CUE = r"\b(?:phone|mobile|cell|whatsapp|contact|tel|hp|my number|call me|reach me|text me)\b"
+CUED_PHONE_RE = re.compile(rf"(?i:{PHONE_CUE})[^\d+\n]{{0,25}}({PHONE_NUMBER})")
+INTL_PHONE_RE = re.compile(rf"(?<![\w$])((?:\+|00)\d[\d\s().-]{{6,20}}\d)(?![\w%])")
+NOT_PHONE_RE = re.compile(r"\d\s+[-\u2013]\s+\d|^\d{1,4}[./-]\d{1,2}[./-]\d{2,4}$|^(?:19|20)\d\d\s*-\s*(?:19|20)\d\d$")
+NAME = r"([A-Z][\w'-]*(?:\s+[A-Z][\w'-]*){0,2})"
+STRONG_INTRO = r"\bmy name is|\bmy name's|\bname's|\bcall me(?! at| on)"
+WEAK_INTRO = r"\bi am|\bi'm|\bim|\bthis is"
+STRONG_NAME_RE = re.compile(rf"(?i:{STRONG_INTRO})\s+{NAME}")
+WEAK_NAME_RE = re.compile(rf"(?i:{WEAK_INTRO})\s+{NAME}")
+STRONG_INTRO_RE = re.compile(STRONG_INTRO, re.I)
+
+# Counters for how often the LLM could be skipped
+EXTRACTION_STATS = {"fast_path_hits": 0, "llm_escalations": 0}
+metrics.register_collector(lambda: prefixed("lead_extraction", EXTRACTION_STATS))
+
+def find_phone(message_content: str) -> Optional[str]:
+    """
+        Returns the phone number in the message, if it's introduced as one ("my mobile is ...")
+        or written in international format (+65 ..., 0065 ...).
+    """
+    candidates = [match.group(1) for match in CUED_PHONE_RE.finditer(message_content)]
+    candidates += [match.group(1) for match in INTL_PHONE_RE.finditer(message_content)]
+    for candidate in candidates:
+        candidate = candidate.strip()
+        digits = re.sub(r"\D", "", candidate)
+        if 8 <= len(digits) <= 15 and not NOT_PHONE_RE.search(candidate):
+            return candidate
+    return None
+
+def fast_extract(message_content: str, info_requested: bool = False) -> Tuple[Dict, bool]:
+    """
+        Extracts contact details with regexes and a name-introduction heuristic.
+
+        Args:
+            message_content: The message entered by the user.
+            info_requested: Whether the bot's last message asked for name or email.
+
+        Returns a tuple of the extracted fields and whether the message is ambiguous
+        and needs the LLM to decide.
+    """
+    found = {}
+    ambiguous = False
+
+    email = EMAIL_RE.search(message_content)
+    if email:
+        found["email"] = email.group()
+    elif "@" in message_content:
+        ambiguous = True
+
+    phone = find_phone(message_content)
+    if phone:
+        found["phone"] = phone
+
+    # "my name is X" is trusted, "I'm X" is left to the LLM since it's just as often
+    # "I'm Indian" or "I'm Looking for...", whatever else the message contains
+    name = STRONG_NAME_RE.search(message_content)
+    weak_name = WEAK_NAME_RE.search(message_content)
+    if name:
+        found["name"] = name.group(1)
+    elif weak_name or STRONG_INTRO_RE.search(message_content):
+        ambiguous = True
+    elif info_requested and "?" not in message_content and len(message_content.split()) <= 4:
+        # A short reply to our request may just be a bare name
+        ambiguous = True
+
+    return found, ambiguous
 
 class LeadInfo(BaseModel):
     """
@@ -37,18 +112,22 @@ class LeadCapture:
             lead_info (LeadInfo) : stores lead information.
             questions_asked (boolean) : counts the number of questions asked for throwing the lead capture request. 
             info_captured (boolane) : flag that says if all the required info is captured or not.
+            last_info_request (str) : the info request sent with the last answer, if any. The history
+                is stored without it, so it's kept here for the next extraction.
     """
     def __init__(self, llm):
         """
             Initializes a new Lead Capture object.
 
             Args:
-                llm : the LLM model that is used to perform the lead capture.
+                llm : the LLM model that is used to perform the lead capture, it's called
+                    through the gateway with the lowest priority.
         """
         self.lead_info = LeadInfo()
         self.questions_asked = 0
         self.info_captured = False
-        self.llm = llm
+        self.last_info_request = None
+        self.llm = with_priority(llm, "extraction")
     
     async def extract_info_from_message(self, message_content: str, history: List[Dict]) -> bool:
         """
@@ -56,17 +135,25 @@ class LeadCapture:
             
             Args:
                 message_content: The message entered by the user.
-                history: The User and Chat bot's history of conversation.
+                history: The User and Chat bot's history of conversation (stored without the
+                    info requests, see last_info_request).
         """
+        # The request only applies to the message right after it
+        last_request, self.last_info_request = self.last_info_request, None
 
         if self.info_captured: 
             return False
             
         context = ""
-        if history:
-            last_msg = history[-1]["ai"] if history else ""
-            if "could you share your name" in last_msg.lower() or "email" in last_msg.lower():
-                context = f"Context: {last_msg}\n"
+        if last_request:
+            context = f"Context: {last_request.strip().strip('`')}\n"
+
+        # Try the local extraction first and only ask the LLM when it can't decide
+        found, ambiguous = fast_extract(message_content, info_requested=bool(context))
+        if not ambiguous:
+            EXTRACTION_STATS["fast_path_hits"] += 1
+            return self._apply_extracted(found)
+        EXTRACTION_STATS["llm_escalations"] += 1
 
         prompt = f"""
         Extract contact details from this message. Return ONLY PURE JSON:
@@ -80,21 +167,64 @@ class LeadCapture:
         try:
             response = await self.llm.ainvoke(prompt)
             extracted_info = json.loads(response.content[7:-3])
-            
-            updated = False
-            for field in ["name", "email", "phone"]:
-                if extracted_info.get(field) and getattr(self.lead_info, field) is None:
-                    setattr(self.lead_info, field, extracted_info[field])
-                    updated = True
-            
-            if self.lead_info.is_complete() and not self.info_captured:
-                self.info_captured = True
-                updated = True                
-            return updated
+            # Regex matches are exact, prefer them over the LLM's copy
+            return self._apply_extracted({**extracted_info, **found})
                 
         except Exception as e:
             print(f"Info extraction error: {e}")
-            return False
+            return self._apply_extracted(found)
+
+    def merge(self, lead_info: LeadInfo) -> bool:
+        """
+            Fills in the missing lead fields from another copy of the session's lead info,
+            e.g. one updated by an extraction that finished after its turn.
+            Returns True if anything was updated.
+        """
+        return self._apply_extracted(lead_info.model_dump())
+
+    def _apply_extracted(self, extracted_info: Dict) -> bool:
+        """
+            Fills in the missing lead fields from the extracted info.
+            Returns True if anything was updated.
+        """
+        updated = False
+        for field in ["name", "email", "phone"]:
+            if extracted_info.get(field) and getattr(self.lead_info, field) is None:
+                setattr(self.lead_info, field, extracted_info[field])
+                updated = True
+        
+        if self.lead_info.is_complete() and not self.info_captured:
+            self.info_captured = True
+            updated = True                
+        return updated
+
+    def to_dict(self) -> Dict:
+        """
+            Returns the lead capture state as plain data, without the llm, so it can be
+            stored outside the process.
+        """
+        return {
+            "lead_info": self.lead_info.model_dump(),
+            "questions_asked": self.questions_asked,
+            "info_captured": self.info_captured,
+            "last_info_request": self.last_info_request
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict, llm) -> "LeadCapture":
+        """
+            Rebuilds a LeadCapture from the output of to_dict.
+
+            Args:
+                data: the stored lead capture state.
+                llm: the LLM model that is used to perform the lead capture.
+        """
+        lead_capture = cls(llm)
+        lead_capture.lead_info = LeadInfo(**data["lead_info"])
+        lead_capture.questions_asked = data["questions_asked"]
+        lead_capture.info_captured = data["info_captured"]
+        lead_capture.last_info_request = data.get("last_info_request")
+        return lead_capture
 
     def increment_question(self):
         """
@@ -113,6 +243,10 @@ class LeadCapture:
         """
             A function that sends the chat request to get the required lead info based on what is avilable.
         """
+        self.last_info_request = self._info_request()
+        return self.last_info_request
+
+    def _info_request(self):
         missing = self.lead_info.missing_fields()
         
         if "name" in missing and "email" in missing:
@@ -0,0 +1,254 @@
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+from langchain.schema import Document
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+from metrics import metrics
+
+# Configuration
+LEXICAL_INDEX_FILE = "lexical_index.json"  # Kept inside the index version dir, next to Chroma
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "5"))  # Chunks passed to the prompt
+RETRIEVAL_FETCH_K = int(os.getenv("RETRIEVAL_FETCH_K", "20"))  # Candidates taken from each retriever
+RRF_K = 60  # Reciprocal rank fusion constant, damps the weight of the very first ranks
+BM25_K1 = 1.5
+BM25_B = 0.75
+STORE_PAGE_SIZE = int(os.getenv("STORE_PAGE_SIZE", "1000"))  # Chunks read from Chroma per call when building indexes
+
+# Numbers keep their thousands separators together ("5,600" -> "5600")
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.,][0-9]+)*")
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how",
+    "i", "if", "in", "is", "it", "my", "of", "on", "or", "the", "to", "what", "when", "which",
+    "who", "with", "you", "your", "we", "our"
+}
+
+def tokenize(text: str) -> List[str]:
+    """
+        Lowercased word and number tokens. Short terms like "ep" or "s" (as in "S Pass") are kept.
+    """
+    tokens = []
+    for token in TOKEN_RE.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        if token[0].isdigit():
+            token = token.replace(",", "")
+        tokens.append(token)
+    return tokens
+
+def metadata_matches(metadata: Dict, where: Optional[Dict]) -> bool:
+    """
+        Evaluates the subset of Chroma where clauses we use ($or, $and and equality) on
+        plain metadata, for the indexes that aren't Chroma.
+    """
+    if not where:
+        return True
+    for key, value in where.items():
+        if key == "$or":
+            if not any(metadata_matches(metadata, clause) for clause in value):
+                return False
+        elif key == "$and":
+            if not all(metadata_matches(metadata, clause) for clause in value):
+                return False
+        elif isinstance(value, dict):
+            if metadata.get(key) != value.get("$eq"):
+                return False
+        elif metadata.get(key) != value:
+            return False
+    return True
+
+class LexicalIndex:
+    """
+        BM25 inverted index over the knowledge base chunks.
+
+        Built from the chunks stored in a Chroma index version and persisted next to it,
+        so the lexical and vector indexes always describe the same chunks.
+
+        Attributes:
+            ids (List[str]) : the Chroma chunk ids.
+            texts (List[str]) : the chunk texts.
+            metadatas (List[Dict]) : the chunk metadata.
+            postings (Dict[str, List]) : term -> [[chunk position, term frequency], ...].
+            doc_lengths (List[int]) : number of tokens in each chunk.
+    """
+    def __init__(self, ids: List[str], texts: List[str], metadatas: List[Dict],
+                 postings: Dict[str, List], doc_lengths: List[int]):
+        self.ids = ids
+        self.texts = texts
+        self.metadatas = metadatas
+        self.postings = postings
+        self.doc_lengths = doc_lengths
+        self.avg_length = sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0.0
+        # Chunk positions matching each where clause searched so far, there are only a few
+        self._allowed: Dict[str, set] = {}
+
+    def allowed(self, where: Dict) -> set:
+        key = json.dumps(where, sort_keys=True)
+        if key not in self._allowed:
+            self._allowed[key] = {
+                position for position, metadata in enumerate(self.metadatas) if metadata_matches(metadata, where)
+            }
+        return self._allowed[key]
+
+    @classmethod
+    def build(cls, ids: List[str], texts: List[str], metadatas: List[Dict]) -> "LexicalIndex":
+        postings = defaultdict(list)
+        doc_lengths = []
+        for position, text in enumerate(texts):
+            # Headers are part of what a chunk is about, so they are indexed with it
+            metadata = metadatas[position] or {}
+            tokens = tokenize(" ".join([metadata.get("Section", ""), metadata.get("Subsection", ""), text]))
+            doc_lengths.append(len(tokens))
+            for term, count in Counter(tokens).items():
+                postings[term].append([position, count])
+        return cls(ids, texts, [metadata or {} for metadata in metadatas], dict(postings), doc_lengths)
+
+    def search(self, query: str, k: int, where: Optional[Dict] = None) -> List[Tuple[int, float]]:
+        """
+            Returns up to k (chunk position, BM25 score) pairs, best first, only from the
+            chunks matching the where clause if there is one.
+        """
+        n = len(self.ids)
+        allowed = self.allowed(where) if where else None
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for position, tf in postings:
+                if allowed is not None and position not in allowed:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[position] / self.avg_length)
+                scores[position] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def document(self, position: int) -> Document:
+        return Document(page_content=self.texts[position], metadata=dict(self.metadatas[position]))
+
+    def save(self, persist_dir: str):
+        path = os.path.join(persist_dir, LEXICAL_INDEX_FILE)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "ids": self.ids,
+                "texts": self.texts,
+                "metadatas": self.metadatas,
+                "postings": self.postings,
+                "doc_lengths": self.doc_lengths
+            }, f)
+        os.replace(tmp_path, path)
+
+def iter_stored(vector_db, include: List[str], page_size: int = STORE_PAGE_SIZE) -> Iterator[Dict]:
+    """
+        Reads a Chroma store page by page, so building an index never holds the whole
+        get() result (above all the embeddings) at once. Yields the get() dict of each page.
+    """
+    offset = 0
+    while True:
+        page = vector_db.get(include=include, limit=page_size, offset=offset)
+        if not page["ids"]:
+            return
+        yield page
+        offset += len(page["ids"])
+
+def build_lexical_index(vector_db, persist_dir: str) -> LexicalIndex:
+    """
+        Rebuilds the lexical index from every chunk in the Chroma store and saves it in persist_dir.
+        BM25 statistics are corpus-wide, so the whole index is rebuilt, which is cheap next to embedding.
+    """
+    ids, texts, metadatas = [], [], []
+    for page in iter_stored(vector_db, ["documents", "metadatas"]):
+        ids += page["ids"]
+        texts += page["documents"]
+        metadatas += page["metadatas"]
+    index = LexicalIndex.build(ids, texts, metadatas)
+    index.save(persist_dir)
+    print(f"Lexical index built with {len(index.ids)} chunks and {len(index.postings)} terms")
+    return index
+
+def load_lexical_index(persist_dir: str) -> Optional[LexicalIndex]:
+    """
+        Loads the lexical index of an index version, or None if it has none (legacy index).
+    """
+    path = os.path.join(persist_dir, LEXICAL_INDEX_FILE)
+    if not os.path.exists(path):
+        print(f"No lexical index in {persist_dir}, using vector retrieval only")
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return LexicalIndex(data["ids"], data["texts"], data["metadatas"], data["postings"], data["doc_lengths"])
+
+class HybridRetriever(BaseRetriever):
+    """
+        Fuses vector and BM25 candidates with reciprocal rank fusion.
+
+        Exact terms like "EP", "COMPASS" or salary figures are found by the lexical index
+        even when the embedding misses them, so far fewer chunks are needed in the prompt.
+        Each returned document carries its fused score in metadata["score"], its vector
+        relevance in metadata["vector_score"] and its BM25 score in metadata["lexical_score"]
+        (None when it wasn't a candidate on that side).
+
+        With a topic index both sides only search the chunks of the question's topics (see
+        topic_filter). If that leaves fewer than k vector candidates, the search is widened
+        to the whole knowledge base.
+
+        Attributes:
+            vector_db : the Chroma store.
+            lexical_index (LexicalIndex) : the BM25 index, or None for vector retrieval only.
+            topic_index (TopicIndex) : maps the question to topic filters, or None to search everything.
+            k (int) : documents returned.
+            fetch_k (int) : candidates taken from each retriever before fusion.
+    """
+    vector_db: object
+    lexical_index: Optional[LexicalIndex] = None
+    topic_index: Optional[object] = None
+    k: int = RETRIEVAL_K
+    fetch_k: int = RETRIEVAL_FETCH_K
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        where = self.topic_index.where(query) if self.topic_index is not None else None
+        if where is not None:
+            vector_results = self.vector_db.similarity_search_with_relevance_scores(query, k=self.fetch_k, filter=where)
+            if len(vector_results) < self.k:
+                metrics.inc("topic_filter_widened")
+                where = None
+            else:
+                metrics.inc("topic_filter_applied")
+        if where is None:
+            vector_results = self.vector_db.similarity_search_with_relevance_scores(query, k=self.fetch_k)
+
+        fused: Dict[str, Dict] = {}
+
+        def add(key: str, rank: int, document: Document, source: str, score: float):
+            entry = fused.setdefault(key, {"document": document, "score": 0.0, "vector_score": None, "lexical_score": None})
+            entry["score"] += 1 / (RRF_K + rank + 1)
+            entry[source] = score
+
+        for rank, (document, score) in enumerate(vector_results):
+            add(document.page_content, rank, document, "vector_score", score)
+        if self.lexical_index is not None:
+            for rank, (position, score) in enumerate(self.lexical_index.search(query, self.fetch_k, where)):
+                add(self.lexical_index.texts[position], rank, self.lexical_index.document(position), "lexical_score", score)
+
+        documents = []
+        for entry in sorted(fused.values(), key=lambda entry: entry["score"], reverse=True)[:self.k]:
+            document = Document(page_content=entry["document"].page_content, metadata=dict(entry["document"].metadata))
+            document.metadata["score"] = round(entry["score"], 6)
+            document.metadata["vector_score"] = entry["vector_score"]
+            document.metadata["lexical_score"] = entry["lexical_score"]
+            documents.append(document)
+        return documents
+
+if __name__ == "__main__":
+    # Adds the lexical index to the current version, for indexes built before it existed
+    from index_versions import current_index_dir
+    from rag_pipeline import load_vector_store
+
+    persist_dir = current_index_dir()
+    index = build_lexical_index(load_vector_store(persist_directory=persist_dir), persist_dir)
+    for position, score in index.search("What are EP salary requirements?", 3):
+        print(f"\n{score:.2f} {index.metadatas[position].get('source')}:\n{index.texts[position][:200]}...")
@@ -0,0 +1,320 @@
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import re
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from metrics import metrics, prefixed
+
+# Configuration
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))  # Calls in flight over all priorities
+LLM_REWRITE_CONCURRENCY = int(os.getenv("LLM_REWRITE_CONCURRENCY", "4"))
+LLM_EXTRACTION_CONCURRENCY = int(os.getenv("LLM_EXTRACTION_CONCURRENCY", "2"))
+LLM_SUMMARY_CONCURRENCY = int(os.getenv("LLM_SUMMARY_CONCURRENCY", "1"))
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "32"))  # Calls waiting for a slot, beyond that they are rejected
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "10"))  # Longest wait for a slot
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))  # Per call, or per streamed chunk
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))  # On 429 and 5xx only
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+
+# Lower ranks are served first. User-facing answers (RAG and fallback) beat the query
+# rewrite, which beats lead extraction since that never holds up a reply. Summaries
+# of the conversation are updated after the reply and can wait the longest.
+PRIORITIES = {"answer": 0, "rewrite": 1, "extraction": 2, "summary": 3}
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+RETRYABLE_RE = re.compile(r"\b(?:429|500|502|503|504)\b|resource.?exhausted|rate.?limit|quota|unavailable", re.I)
+
+OVERLOADED_ANSWER = (
+    "We're receiving a lot of questions right now and I couldn't answer this one. "
+    "Please try again in a moment."
+)
+
+class LLMUnavailable(Exception):
+    """
+        The llm call was rejected, timed out or kept failing with retryable errors.
+    """
+
+class LLMOverloaded(LLMUnavailable):
+    """
+        The wait queue was full or the call waited too long for a slot.
+    """
+
+def _status_code(error: BaseException) -> Optional[int]:
+    for attribute in ("status_code", "code", "status"):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+def is_retryable(error: BaseException) -> bool:
+    """
+        Whether an llm error is a rate limit or server error, looking through wrapped causes
+        since the provider SDKs report them as their own exception types.
+    """
+    while error is not None:
+        status = _status_code(error)
+        if status is not None:
+            return status in RETRYABLE_STATUS
+        if RETRYABLE_RE.search(f"{type(error).__name__} {error}"):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+def backoff_seconds(attempt: int) -> float:
+    # Full jitter, so the sessions that were throttled together don't retry together
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+class LLMGateway:
+    """
+        Admission control for every llm call in the process.
+
+        At most max_concurrency calls run at once and each priority has its own limit below
+        that, so lead extraction can never take the slots user-facing answers need. Calls
+        without a free slot wait in a bounded queue and are served by priority. When the
+        queue is full a new call replaces the lowest-priority waiter if it outranks it and
+        is rejected with LLMOverloaded otherwise, as are calls waiting over queue_timeout.
+
+        A call keeps its slot while it backs off from a 429 or 5xx, which is what slows
+        the process down when the provider is throttling it.
+
+        Attributes:
+            max_concurrency (int) : calls in flight over all priorities.
+            limits (Dict[str, int]) : calls in flight per priority.
+            queue_size (int) : most calls waiting for a slot.
+            queue_timeout (float) : longest wait for a slot in seconds.
+            timeout (float) : longest call, or wait for the next streamed chunk, in seconds.
+            max_retries (int) : retries of a call failing with a retryable error.
+            active (Counter) : calls in flight per priority.
+    """
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, limits: Optional[Dict[str, int]] = None,
+                 queue_size: int = LLM_QUEUE_SIZE, queue_timeout: float = LLM_QUEUE_TIMEOUT,
+                 timeout: float = LLM_TIMEOUT, max_retries: int = LLM_MAX_RETRIES):
+        self.max_concurrency = max_concurrency
+        self.limits = limits or {
+            "answer": max_concurrency,
+            "rewrite": LLM_REWRITE_CONCURRENCY,
+            "extraction": LLM_EXTRACTION_CONCURRENCY,
+            "summary": LLM_SUMMARY_CONCURRENCY
+        }
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.active = Counter()
+        # Heap of [rank, sequence, priority, future], the sequence keeps it first come first served
+        self._waiters: List[List] = []
+        self._sequence = itertools.count()
+
+    def _can_start(self, priority: str) -> bool:
+        return (sum(self.active.values()) < self.max_concurrency
+                and self.active[priority] < self.limits.get(priority, self.max_concurrency))
+
+    def _wake(self):
+        """
+            Hands free slots to the waiters, highest priority first.
+        """
+        waiting = []
+        for entry in sorted(self._waiters):
+            future = entry[3]
+            if future.done():
+                continue
+            if self._can_start(entry[2]):
+                self.active[entry[2]] += 1
+                future.set_result(True)
+            else:
+                waiting.append(entry)
+        heapq.heapify(waiting)
+        self._waiters = waiting
+
+    def _make_room(self, rank: int, priority: str):
+        """
+            Rejects the lowest-priority waiter if the queue is full and it's outranked by rank.
+        """
+        if len(self._waiters) < self.queue_size:
+            return
+        worst = max(self._waiters)
+        if worst[0] <= rank:
+            metrics.inc("llm_rejected")
+            raise LLMOverloaded(f"LLM queue full ({self.queue_size} waiting)")
+        self._waiters.remove(worst)
+        heapq.heapify(self._waiters)
+        metrics.inc("llm_rejected")
+        worst[3].set_exception(LLMOverloaded(f"Displaced from the LLM queue by a {priority}-priority call"))
+
+    async def acquire(self, priority: str):
+        start = time.monotonic()
+        rank = PRIORITIES.get(priority, len(PRIORITIES))
+        self._make_room(rank, priority)
+        future = asyncio.get_running_loop().create_future()
+        entry = [rank, next(self._sequence), priority, future]
+        heapq.heappush(self._waiters, entry)
+        self._wake()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._abandon(entry)
+            metrics.inc("llm_rejected")
+            raise LLMOverloaded(f"Waited over {self.queue_timeout}s for an LLM slot") from None
+        except BaseException:
+            # Cancelled by the caller (e.g. the extraction deadline) or displaced
+            self._abandon(entry)
+            raise
+        finally:
+            metrics.observe(f"llm_wait_{priority}", time.monotonic() - start, priority=priority)
+
+    def _abandon(self, entry: List):
+        future = entry[3]
+        if future.done() and not future.cancelled() and future.exception() is None:
+            # The slot was granted just as the wait ended
+            self.release(entry[2])
+            return
+        future.cancel()
+        if entry in self._waiters:
+            self._waiters.remove(entry)
+            heapq.heapify(self._waiters)
+
+    def release(self, priority: str):
+        self.active[priority] -= 1
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, priority: str):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    async def _backoff(self, error: Exception, attempt: int, priority: str):
+        if not is_retryable(error):
+            raise error
+        if attempt >= self.max_retries:
+            metrics.inc("llm_failures")
+            raise LLMUnavailable(f"LLM call failed after {attempt + 1} attempts: {error}") from error
+        metrics.inc("llm_retries")
+        delay = backoff_seconds(attempt)
+        print(f"LLM call ({priority}) failed with {error!r}, retrying in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+    async def ainvoke(self, llm, input, priority: str = "answer", **kwargs):
+        """
+            Invokes llm once a slot is free, with a timeout and retries on 429 and 5xx.
+        """
+        async with self.slot(priority):
+            attempt = 0
+            while True:
+                try:
+                    return await asyncio.wait_for(llm.ainvoke(input, **kwargs), self.timeout)
+                except asyncio.TimeoutError:
+                    metrics.inc("llm_timeouts")
+                    raise LLMUnavailable(f"LLM call took over {self.timeout}s") from None
+                except Exception as e:
+                    await self._backoff(e, attempt, priority)
+                    attempt += 1
+
+    async def astream(self, llm, input, priority: str = "answer", **kwargs) -> AsyncIterator:
+        """
+            Streams from llm once a slot is free. The timeout applies to every chunk, and a
+            failed stream is only retried if nothing was yielded yet.
+        """
+        async with self.slot(priority):
+            attempt = 0
+            while True:
+                stream = llm.astream(input, **kwargs)
+                started = False
+                try:
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(stream.__anext__(), self.timeout)
+                        except StopAsyncIteration:
+                            return
+                        started = True
+                        yield chunk
+                except asyncio.TimeoutError:
+                    metrics.inc("llm_timeouts")
+                    raise LLMUnavailable(f"No LLM output for {self.timeout}s") from None
+                except Exception as e:
+                    if started:
+                        raise
+                    await self._backoff(e, attempt, priority)
+                    attempt += 1
+                finally:
+                    await stream.aclose()
+
+    def stats(self) -> Dict:
+        stats = {"active": sum(self.active.values()), "queue_depth": len(self._waiters)}
+        for priority in PRIORITIES:
+            stats[f"active_{priority}"] = self.active[priority]
+            stats[f"queue_depth_{priority}"] = sum(1 for entry in self._waiters if entry[2] == priority)
+        return stats
+
+# Process-wide, like the engine, so the limits hold across sessions
+gateway = LLMGateway()
+metrics.register_collector(lambda: prefixed("llm", gateway.stats()))
+
+class GatewayChatModel(BaseChatModel):
+    """
+        A chat model that sends every async call of the wrapped model through the gateway
+        with a fixed priority, so it can be used anywhere a chat model is, including chains.
+
+        Sync calls (only test_rag makes them) are retried but not admission controlled,
+        the limits are enforced on the event loop.
+
+        Attributes:
+            llm : the wrapped chat model.
+            priority (str) : answer, rewrite, extraction or summary.
+    """
+    llm: Any
+    priority: str = "answer"
+
+    @property
+    def _llm_type(self) -> str:
+        return f"gateway-{self.llm._llm_type}"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        for attempt in range(gateway.max_retries + 1):
+            try:
+                message = self.llm.invoke(messages, stop=stop, **kwargs)
+                return ChatResult(generations=[ChatGeneration(message=message)])
+            except Exception as e:
+                if not is_retryable(e) or attempt == gateway.max_retries:
+                    raise
+                time.sleep(backoff_seconds(attempt))
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        for chunk in self.llm.stream(messages, stop=stop, **kwargs):
+            yield ChatGenerationChunk(message=chunk)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        message = await gateway.ainvoke(self.llm, messages, self.priority, stop=stop, **kwargs)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        async for chunk in gateway.astream(self.llm, messages, self.priority, stop=stop, **kwargs):
+            yield ChatGenerationChunk(message=chunk)
+
+def with_priority(llm, priority: str) -> GatewayChatModel:
+    """
+        Returns llm routed through the gateway with the given priority. An already
+        wrapped model is re-wrapped, so the shared llm can be passed around as is.
+    """
+    if isinstance(llm, GatewayChatModel):
+        if llm.priority == priority:
+            return llm
+        llm = llm.llm
+    return GatewayChatModel(llm=llm, priority=priority)
@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import os
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+FAKE_LLM_FIRST_TOKEN_LATENCY = float(os.getenv("FAKE_LLM_FIRST_TOKEN_LATENCY", "0.4"))
+FAKE_LLM_TOKEN_LATENCY = float(os.getenv("FAKE_LLM_TOKEN_LATENCY", "0.01"))
+FAKE_LLM_FALLBACK_RATE = float(os.getenv("FAKE_LLM_FALLBACK_RATE", "0.1"))
+
+FAKE_ANSWER = (
+    "Here is a summary based on our knowledge base:\n"
+    "- The Employment Pass is for professionals, managers and executives.\n"
+    "- Applicants need a job offer and must meet the qualifying salary.\n"
+    "- Processing usually takes around 3 weeks."
+)
+FAKE_FALLBACK_ANSWER = (
+    "In general this depends on your situation. Most applications need a valid passport, "
+    "supporting documents and time for the authorities to process them."
+)
+FAKE_SUMMARY = "The user is asking about Singapore work passes and setting up a company."
+FAKE_EXTRACTION = '```json\n{"name": null, "email": null, "phone": null}\n```'
+
+class FakeChatModel(BaseChatModel):
+    """
+        Deterministic stand-in for Gemini that costs no quota.
+
+        The reply depends only on the prompt: lead extraction gets empty JSON, the fallback
+        prompt a general answer, summary updates a fixed summary, and RAG prompts a fixed
+        answer, or <SERVICE_FALLBACK> for a stable fallback_rate share of questions. Latency
+        is a first-token delay plus a delay per streamed word, so runs are comparable
+        between commits.
+
+        Attributes:
+            first_token_latency (float) : seconds before the first token.
+            token_latency (float) : seconds between streamed words.
+            fallback_rate (float) : share of RAG prompts answered with the sentinel.
+    """
+    first_token_latency: float = FAKE_LLM_FIRST_TOKEN_LATENCY
+    token_latency: float = FAKE_LLM_TOKEN_LATENCY
+    fallback_rate: float = FAKE_LLM_FALLBACK_RATE
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _reply(self, messages: List[BaseMessage]) -> str:
+        prompt = "\n".join(str(message.content) for message in messages)
+        if "Extract contact details" in prompt:
+            return FAKE_EXTRACTION
+        if "Update the conversation summary" in prompt:
+            return FAKE_SUMMARY
+        if "Fallback Specialist" in prompt:
+            return FAKE_FALLBACK_ANSWER
+        if "Rewrite the follow-up question" in prompt:
+            return prompt.rsplit("**Follow-up question**:", 1)[-1].split("\n", 1)[0].strip()
+        question = prompt.rsplit("**Question:**", 1)[-1]
+        bucket = int(hashlib.md5(question.encode()).hexdigest(), 16) % 1000
+        if bucket < self.fallback_rate * 1000:
+            return "<SERVICE_FALLBACK>"
+        return FAKE_ANSWER
+
+    def _words(self, text: str) -> List[str]:
+        words = text.split(" ")
+        return [word + " " for word in words[:-1]] + words[-1:]
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        text = self._reply(messages)
+        time.sleep(self.first_token_latency + self.token_latency * len(self._words(text)))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        text = self._reply(messages)
+        await asyncio.sleep(self.first_token_latency + self.token_latency * len(self._words(text)))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.first_token_latency)
+        for word in self._words(self._reply(messages)):
+            time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.first_token_latency)
+        for word in self._words(self._reply(messages)):
+            await asyncio.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word))
+
+def create_llm(provider: Optional[str] = None):
+    """
+        Creates the chat model shared by the RAG chain, lead capture and fallback.
+
+        LLM_PROVIDER picks gemini (the default) or fake, which answers locally with a
+        configurable latency so the service can be benchmarked without spending quota.
+    """
+    if provider is None:
+        provider = os.getenv("LLM_PROVIDER", "gemini")
+    if provider == "fake":
+        return FakeChatModel()
+    if provider != "gemini":
+        raise ValueError(f"Unknown LLM provider: {provider}")
+
+    from langchain_google_genai import ChatGoogleGenerativeAI  # Or your preferred LLM
+    return ChatGoogleGenerativeAI(
+        model="gemini-2.0-flash",
+        temperature=0.6,
+        google_api_key=os.getenv("GOOGLE_API_KEY"),
+        # Retries with backoff are done by the llm gateway, which also limits concurrency
+        max_retries=1
+    )
@@ -0,0 +1,273 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Where the turn metrics go besides /metrics: none, console, file or otel
+METRICS_EXPORTER = os.getenv("METRICS_EXPORTER", "none")
+METRICS_FILE = os.getenv("METRICS_FILE", "metrics.jsonl")
+METRICS_EXPORT_INTERVAL = float(os.getenv("METRICS_EXPORT_INTERVAL", "60"))
+METRICS_PREFIX = "incorp"
+
+# Upper bounds in seconds, from a cache hit to a slow fallback generation
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+DEFAULT_OUTCOME = "ok"  # Outcome label of spans that don't set one
+
+class Histogram:
+    """
+        Histogram in the Prometheus layout, latencies by default.
+
+        Attributes:
+            buckets (List[float]) : upper bounds of the buckets, +Inf is implicit.
+            counts (List[int]) : observations per bucket (not cumulative), the last one is +Inf.
+            sum (float) : total of all observations.
+            count (int) : number of observations.
+    """
+    def __init__(self, buckets: List[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+            Upper bound of the bucket holding the q-quantile, an estimate good enough for dashboards.
+        """
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+class Exporter:
+    """
+        Receives every finished span and a periodic snapshot of all metrics.
+    """
+    def export_span(self, stage: str, start: float, seconds: float, attributes: Dict):
+        pass
+
+    def export_snapshot(self, snapshot: Dict):
+        pass
+
+class ConsoleExporter(Exporter):
+    def export_snapshot(self, snapshot: Dict):
+        print(f"Metrics: {json.dumps(snapshot)}")
+
+class FileExporter(Exporter):
+    """
+        Appends spans and snapshots as JSON lines, for offline analysis without a collector.
+    """
+    def __init__(self, path: str = METRICS_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _write(self, record: Dict):
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def export_span(self, stage: str, start: float, seconds: float, attributes: Dict):
+        self._write({"type": "span", "stage": stage, "start": start, "seconds": round(seconds, 6), **attributes})
+
+    def export_snapshot(self, snapshot: Dict):
+        self._write({"type": "snapshot", "time": time.time(), **snapshot})
+
+class OtelExporter(Exporter):
+    """
+        Turns the spans into OpenTelemetry spans, sent wherever the OTEL_* environment
+        variables point the OTLP exporter.
+    """
+    def __init__(self):
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+        provider = TracerProvider(resource=Resource.create({"service.name": "incorp-chatbot"}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        trace.set_tracer_provider(provider)
+        self.tracer = trace.get_tracer("incorp-chatbot")
+
+    def export_span(self, stage: str, start: float, seconds: float, attributes: Dict):
+        start_ns = int(start * 1e9)
+        span = self.tracer.start_span(stage, start_time=start_ns, attributes=attributes)
+        span.end(end_time=start_ns + int(seconds * 1e9))
+
+def create_exporter(name: str = METRICS_EXPORTER) -> Exporter:
+    if name == "console":
+        return ConsoleExporter()
+    if name == "file":
+        return FileExporter()
+    if name == "otel":
+        try:
+            return OtelExporter()
+        except ImportError as e:
+            print(f"OpenTelemetry exporter unavailable ({e}), metrics are only served on /metrics")
+    return Exporter()
+
+class Metrics:
+    """
+        Process-wide stage histograms, counters and collectors.
+
+        Stages of a turn are timed with span(). Counters are incremented where things
+        happen, collectors expose stats that are already kept elsewhere (lead extraction,
+        router, fallback, answer cache, sessions) so they don't need to be counted twice.
+
+        Attributes:
+            stages (Dict[Tuple[str, str], Histogram]) : latency histogram per stage and outcome.
+                The outcome attribute of a span (e.g. "fallback") gets its own histogram,
+                so the latencies of failed or degraded turns don't blur the normal ones.
+            histograms (Dict[str, Histogram]) : other distributions, e.g. embedding batch sizes.
+            counters (Dict[str, float]) : monotonically increasing counters.
+            exporter (Exporter) : where spans and snapshots are sent besides /metrics.
+    """
+    def __init__(self, exporter: Optional[Exporter] = None):
+        self.stages: Dict[Tuple[str, str], Histogram] = defaultdict(Histogram)
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, float] = defaultdict(float)
+        self.exporter = exporter if exporter is not None else create_exporter()
+        self._collectors: List[Callable[[], Dict[str, float]]] = []
+
+    def observe(self, stage: str, seconds: float, start: Optional[float] = None, **attributes):
+        self.stages[(stage, attributes.get("outcome", DEFAULT_OUTCOME))].observe(seconds)
+        self.exporter.export_span(stage, start if start is not None else time.time() - seconds, seconds, attributes)
+
+    @contextmanager
+    def span(self, stage: str, **attributes):
+        """
+            Times the enclosed block as one stage. Works in sync and async code alike.
+        """
+        start = time.time()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started, start, **attributes)
+
+    def record(self, name: str, value: float, buckets: List[float]):
+        """
+            Adds a value to a named histogram that isn't a stage latency.
+        """
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(buckets)
+        self.histograms[name].observe(value)
+
+    def inc(self, name: str, value: float = 1):
+        self.counters[name] += value
+
+    def register_collector(self, collector: Callable[[], Dict[str, float]]):
+        """
+            Registers a callable returning {metric name: value}, read at every scrape.
+        """
+        self._collectors.append(collector)
+
+    def _collected(self) -> Dict[str, float]:
+        values = {}
+        for collector in self._collectors:
+            try:
+                values.update(collector())
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+        return values
+
+    def snapshot(self) -> Dict:
+        """
+            All metrics as plain JSON, with p50/p95/p99 estimates per stage. Stages with
+            another outcome than the default are listed as stage/outcome.
+        """
+        return {
+            "stages": {
+                stage if outcome == DEFAULT_OUTCOME else f"{stage}/{outcome}": {
+                    "count": histogram.count,
+                    "sum": round(histogram.sum, 6),
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95),
+                    "p99": histogram.quantile(0.99)
+                }
+                for (stage, outcome), histogram in self.stages.items()
+            },
+            "histograms": {
+                name: {
+                    "count": histogram.count,
+                    "mean": round(histogram.sum / histogram.count, 3) if histogram.count else None,
+                    "buckets": dict(zip([str(bound) for bound in histogram.buckets] + ["+Inf"], histogram.counts))
+                }
+                for name, histogram in self.histograms.items()
+            },
+            "counters": dict(self.counters),
+            "gauges": self._collected()
+        }
+
+    def render_prometheus(self) -> str:
+        """
+            Renders the metrics in the Prometheus text exposition format.
+        """
+        lines = [
+            f"# HELP {METRICS_PREFIX}_stage_seconds Time spent in each stage of a chat turn.",
+            f"# TYPE {METRICS_PREFIX}_stage_seconds histogram"
+        ]
+        for (stage, outcome), histogram in sorted(self.stages.items()):
+            lines.extend(_histogram_lines(
+                f"{METRICS_PREFIX}_stage_seconds", histogram, f'stage="{stage}",outcome="{outcome}"'
+            ))
+        for name, histogram in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name} histogram")
+            lines.extend(_histogram_lines(f"{METRICS_PREFIX}_{name}", histogram))
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name}_total counter")
+            lines.append(f"{METRICS_PREFIX}_{name}_total {value}")
+        for name, value in sorted(self._collected().items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name} gauge")
+            lines.append(f"{METRICS_PREFIX}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def export_periodically(self, interval: float = METRICS_EXPORT_INTERVAL):
+        """
+            Sends a snapshot to the exporter every interval seconds.
+        """
+        if type(self.exporter) is Exporter or interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.exporter.export_snapshot(self.snapshot())
+            except Exception as e:
+                print(f"Metrics export failed: {e}")
+
+def _histogram_lines(name: str, histogram: Histogram, labels: str = "") -> List[str]:
+    lines = []
+    cumulative = 0
+    separator = "," if labels else ""
+    for bound, count in zip(histogram.buckets + [float("inf")], histogram.counts):
+        cumulative += count
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append(f'{name}_bucket{{{labels}{separator}le="{le}"}} {cumulative}')
+    suffix = f"{{{labels}}}" if labels else ""
+    lines.append(f"{name}_sum{suffix} {histogram.sum}")
+    lines.append(f"{name}_count{suffix} {histogram.count}")
+    return lines
+
+def prefixed(prefix: str, stats: Dict) -> Dict[str, float]:
+    """
+        Flattens an existing stats dict into metric names, e.g. fallback_turns.
+    """
+    return {f"{prefix}_{key}": value for key, value in stats.items()}
+
+# Process-wide metrics, like the engine
+metrics = Metrics()
@@ -0,0 +1,257 @@
+import json
+import math
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from langchain.schema import Document
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+from lexical_index import iter_stored, metadata_matches
+
+# Configuration
+VECTORS_FILE = "vectors.npy"  # Kept inside the index version dir, next to Chroma
+CHUNKS_FILE = "chunks.json"  # Ids, texts and metadata of the rows of VECTORS_FILE
+VECTOR_STORE_DTYPE = os.getenv("VECTOR_STORE_DTYPE", "float32")  # float32 or float16
+
+def _relevance(similarity: np.ndarray) -> np.ndarray:
+    """
+        Converts cosine similarity into the relevance score LangChain's Chroma reports
+        (1 - squared L2 distance / sqrt(2) on normalized vectors), so the retrieval
+        thresholds tuned on Chroma carry over unchanged.
+    """
+    return 1.0 - (2.0 - 2.0 * similarity) / math.sqrt(2)
+
+def mmr_select(query: np.ndarray, candidates: np.ndarray, k: int, lambda_mult: float = 0.5) -> List[int]:
+    """
+        Maximal marginal relevance over normalized vectors, returns positions in candidates.
+    """
+    if not len(candidates):
+        return []
+    query_similarity = candidates @ query
+    pairwise = candidates @ candidates.T
+    selected = [int(np.argmax(query_similarity))]
+    # Highest similarity of every candidate to anything already selected
+    redundancy = pairwise[selected[0]].copy()
+    while len(selected) < min(k, len(candidates)):
+        scores = lambda_mult * query_similarity - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        redundancy = np.maximum(redundancy, pairwise[best])
+    return selected
+
+class MmapVectorStore:
+    """
+        Exact-search vector store over a memory-mapped .npy matrix of normalized embeddings.
+
+        The matrix is opened with mmap_mode="r", so every worker on a node shares one copy
+        from the page cache and opening the store costs next to nothing. Search is a single
+        matrix-vector product over all chunks, which is exact and fast at our corpus size.
+
+        Attributes:
+            vectors (np.ndarray) : the memory-mapped (chunks x dimensions) matrix.
+            ids (List[str]) : the chunk ids, one per row.
+            texts (List[str]) : the chunk texts.
+            metadatas (List[Dict]) : the chunk metadata.
+            embeddings : the embedding model used for queries.
+    """
+    def __init__(self, vectors: np.ndarray, ids: List[str], texts: List[str], metadatas: List[Dict], embeddings=None):
+        self.vectors = vectors
+        self.ids = ids
+        self.texts = texts
+        self.metadatas = metadatas
+        self.embeddings = embeddings
+        # Rows matching each filter searched so far, like LexicalIndex.allowed
+        self._rows: Dict[str, np.ndarray] = {}
+
+    @classmethod
+    def load(cls, persist_dir: str, embeddings=None) -> "MmapVectorStore":
+        vectors = np.load(os.path.join(persist_dir, VECTORS_FILE), mmap_mode="r")
+        with open(os.path.join(persist_dir, CHUNKS_FILE), "r", encoding="utf-8") as f:
+            chunks = json.load(f)
+        return cls(vectors, chunks["ids"], chunks["texts"], chunks["metadatas"], embeddings)
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def get(self, include: Optional[List[str]] = None) -> Dict:
+        """
+            Same shape as Chroma's get(), so the lexical index can be built from either store.
+        """
+        return {"ids": self.ids, "documents": self.texts, "metadatas": self.metadatas}
+
+    def _filtered_rows(self, filter: Dict) -> np.ndarray:
+        key = json.dumps(filter, sort_keys=True)
+        if key not in self._rows:
+            self._rows[key] = np.array(
+                [row for row, metadata in enumerate(self.metadatas) if metadata_matches(metadata or {}, filter)],
+                dtype=np.int64
+            )
+        return self._rows[key]
+
+    def _scores(self, vector, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        query = np.asarray(vector, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        # Only the filtered rows are read and multiplied
+        vectors = self.vectors if rows is None else self.vectors[rows]
+        if vectors.dtype == np.float32:
+            return vectors @ query
+        # float16 has no BLAS path, compute on the upcast matrix
+        return vectors.astype(np.float32) @ query
+
+    def _document(self, position: int) -> Document:
+        return Document(page_content=self.texts[position], metadata=dict(self.metadatas[position] or {}))
+
+    def similarity_search_by_vector_with_relevance_scores(self, vector, k: int = 4,
+                                                          filter: Optional[Dict] = None) -> List[Tuple[Document, float]]:
+        """
+            Top k chunks by cosine similarity. filter takes the Chroma where clauses of
+            lexical_index.metadata_matches.
+        """
+        rows = self._filtered_rows(filter) if filter else None
+        scores = self._scores(vector, rows)
+        k = min(k, len(scores))
+        if not k:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        relevance = _relevance(scores[top])
+        positions = top if rows is None else rows[top]
+        return [(self._document(int(position)), float(score)) for position, score in zip(positions, relevance)]
+
+    def similarity_search_with_relevance_scores(self, query: str, k: int = 4,
+                                                filter: Optional[Dict] = None) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_relevance_scores(self.embeddings.embed_query(query), k, filter)
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[Dict] = None) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_relevance_scores(query, k, filter)]
+
+    def max_marginal_relevance_search(self, query: str, k: int = 4, fetch_k: int = 20,
+                                      lambda_mult: float = 0.5) -> List[Document]:
+        query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        query_vector /= max(float(np.linalg.norm(query_vector)), 1e-12)
+        scores = self._scores(query_vector)
+        fetch_k = min(fetch_k, len(scores))
+        if not fetch_k:
+            return []
+        candidates = np.argpartition(-scores, fetch_k - 1)[:fetch_k]
+        candidate_vectors = np.asarray(self.vectors[candidates], dtype=np.float32)
+        selected = mmr_select(query_vector, candidate_vectors, k, lambda_mult)
+        return [self._document(int(candidates[position])) for position in selected]
+
+    def as_retriever(self, search_type: str = "similarity", search_kwargs: Optional[Dict] = None) -> "MmapRetriever":
+        return MmapRetriever(store=self, search_type=search_type, search_kwargs=search_kwargs or {})
+
+    def close(self):
+        # Dropping the memory map is all there is to release
+        self.vectors = None
+
+class MmapRetriever(BaseRetriever):
+    """
+        Similarity or MMR retriever over a MmapVectorStore, for use without the lexical index.
+    """
+    store: object
+    search_type: str = "similarity"
+    search_kwargs: Dict = {}
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        if self.search_type == "mmr":
+            return self.store.max_marginal_relevance_search(query, **self.search_kwargs)
+        return self.store.similarity_search(query, **self.search_kwargs)
+
+def export_mmap_store(vector_db, persist_dir: str, dtype: str = VECTOR_STORE_DTYPE):
+    """
+        Writes the embeddings, texts and metadata of a Chroma store as a MmapVectorStore.
+    """
+    # The vectors go straight from each page into the file, only the texts and metadata
+    # (much smaller than the vectors) are collected
+    count = len(vector_db.get(include=[])["ids"])
+    vectors_path = os.path.join(persist_dir, VECTORS_FILE)
+    vectors = None
+    ids, texts, metadatas = [], [], []
+    # Written under temporary names and renamed, so a reader never sees half a file
+    for page in iter_stored(vector_db, ["embeddings", "documents", "metadatas"]):
+        page_vectors = np.asarray(page["embeddings"], dtype=np.float32).reshape(len(page["ids"]), -1)
+        page_vectors /= np.clip(np.linalg.norm(page_vectors, axis=1, keepdims=True), 1e-12, None)
+        if vectors is None:
+            vectors = np.lib.format.open_memmap(f"{vectors_path}.tmp", mode="w+", dtype=dtype,
+                                                shape=(count, page_vectors.shape[1]))
+        vectors[len(ids):len(ids) + len(page_vectors)] = page_vectors
+        ids += page["ids"]
+        texts += page["documents"]
+        metadatas += page["metadatas"]
+    if vectors is None:
+        # Empty store
+        with open(f"{vectors_path}.tmp", "wb") as f:
+            np.save(f, np.zeros((0, 0), dtype=dtype))
+    else:
+        vectors.flush()
+        del vectors
+    chunks_path = os.path.join(persist_dir, CHUNKS_FILE)
+    with open(f"{chunks_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump({"ids": ids, "texts": texts, "metadatas": metadatas}, f)
+    os.replace(f"{vectors_path}.tmp", vectors_path)
+    os.replace(f"{chunks_path}.tmp", chunks_path)
+    print(f"Memory-mapped vector store written with {len(ids)} {dtype} vectors")
+
+def _bench_backend(backend: str, persist_dir: str, query_vectors: List[List[float]], k: int, rounds: int, queue):
+    import resource
+
+    start = time.perf_counter()
+    if backend == "chroma":
+        from langchain_community.vectorstores import Chroma
+        store = Chroma(persist_directory=persist_dir)
+        search = store.similarity_search_by_vector_with_relevance_scores
+    else:
+        store = MmapVectorStore.load(persist_dir)
+        search = store.similarity_search_by_vector_with_relevance_scores
+    results = [[document.page_content for document, _ in search(vector, k=k)] for vector in query_vectors]
+    load_seconds = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(rounds):
+        for vector in query_vectors:
+            started = time.perf_counter()
+            search(vector, k=k)
+            latencies.append((time.perf_counter() - started) * 1000)
+    queue.put({
+        "backend": backend,
+        "first_query_seconds": round(load_seconds, 3),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "results": results
+    })
+
+if __name__ == "__main__":
+    # Exports the current index version if needed, then compares both backends, each in
+    # a fresh process that only opens the store (the query vectors are embedded here)
+    import multiprocessing
+    from embedding_bench import SAMPLE_QUERIES
+    from embeddings import get_embeddings
+    from index_versions import current_index_dir
+
+    persist_dir = current_index_dir()
+    if not os.path.exists(os.path.join(persist_dir, VECTORS_FILE)):
+        from langchain_community.vectorstores import Chroma
+        export_mmap_store(Chroma(persist_directory=persist_dir), persist_dir)
+
+    k = 10
+    query_vectors = get_embeddings().embed_documents(SAMPLE_QUERIES)
+    context = multiprocessing.get_context("spawn")
+    reports = {}
+    for backend in ("chroma", "mmap"):
+        queue = context.Queue()
+        process = context.Process(target=_bench_backend, args=(backend, persist_dir, query_vectors, k, 50, queue))
+        process.start()
+        reports[backend] = queue.get()
+        process.join()
+
+    overlaps = [
+        len(set(a) & set(b)) / k
+        for a, b in zip(reports["chroma"].pop("results"), reports["mmap"].pop("results"))
+    ]
+    for report in reports.values():
+        print(json.dumps(report))
+    print(f"Top-{k} agreement with Chroma: mean {np.mean(overlaps):.3f}, min {min(overlaps):.3f}")
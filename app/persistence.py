@@ -0,0 +1,367 @@
+import asyncio
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
+from psycopg2.extras import execute_batch
+from psycopg2.pool import ThreadedConnectionPool
+from lead_capture import LeadInfo
+from metrics import metrics
+
+# Database configuration
+DB_CONFIG = {
+    "host": os.getenv("POSTGRES_HOST", "localhost"),
+    "database": os.getenv("POSTGRES_DB", "database"),
+    "user": os.getenv("POSTGRES_USER", "postgres"),
+    "password": os.getenv("POSTGRES_PASSWORD", "postgres"),
+    "port": os.getenv("POSTGRES_PORT", "5432")
+}
+
+# The lead row only carries lead fields, messages go to the append-only chat_messages table.
+# A session that starts over (e.g. it expired and couldn't be restored) has no lead fields
+# yet, so a stored field is never overwritten with NULL and a conversion is never undone.
+UPSERT_LEAD = """
+    INSERT INTO chats (id, name, email, phone, conversion)
+    VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT (id) DO UPDATE SET
+        name = COALESCE(EXCLUDED.name, chats.name),
+        email = COALESCE(EXCLUDED.email, chats.email),
+        phone = COALESCE(EXCLUDED.phone, chats.phone),
+        conversion = chats.conversion OR EXCLUDED.conversion,
+        last_updated = NOW()
+    WHERE (chats.name, chats.email, chats.phone, chats.conversion) IS DISTINCT FROM (
+        COALESCE(EXCLUDED.name, chats.name), COALESCE(EXCLUDED.email, chats.email),
+        COALESCE(EXCLUDED.phone, chats.phone), chats.conversion OR EXCLUDED.conversion
+    )
+"""
+
+# A session that starts over numbers its turns from 0 again, so the turn goes after the
+# stored transcript instead of being swallowed by the primary key
+INSERT_MESSAGE = """
+    INSERT INTO chat_messages (chat_id, turn_index, user_message, ai_message)
+    SELECT %s, GREATEST(%s, COALESCE(MAX(turn_index) + 1, 0)), %s, %s
+    FROM chat_messages WHERE chat_id = %s
+    ON CONFLICT (chat_id, turn_index) DO NOTHING
+"""
+
+SELECT_MESSAGES = """
+    SELECT user_message, ai_message FROM chat_messages
+    WHERE chat_id = %s ORDER BY turn_index
+"""
+
+# Chats written before the chat_messages migration still have their transcript in chats.chat
+SELECT_LEGACY_CHAT = "SELECT chat FROM chats WHERE id = %s"
+
+SELECT_LEAD = "SELECT name, email, phone, conversion FROM chats WHERE id = %s"
+
+class LeadStore:
+    """
+        Pooled, write-behind persistence for chat leads.
+
+        save() only queues the work for one turn and returns immediately. A background
+        task flushes the queue in grouped transactions on a small thread pool, so the
+        blocking psycopg2 calls never run on the event loop.
+
+        Each turn is appended to chat_messages once, and the lead row in chats is only
+        written when the lead fields or the conversion flag change, so the write volume
+        per turn stays constant however long the conversation gets.
+
+        A failed batch is retried with the next flushes. While the database stays down,
+        batches are dropped after max_retries failed flushes in a row and the queue never
+        holds more than max_pending messages, so an outage can't grow it without bound.
+
+        Attributes:
+            flush_interval (float) : seconds between background flushes.
+            batch_size (int) : number of pending writes that triggers an early flush.
+            max_retries (int) : failed flushes in a row after which a failed batch is dropped.
+            max_pending (int) : most messages kept queued, the oldest are dropped first.
+    """
+    def __init__(self, db_config: Dict = DB_CONFIG, max_connections: int = 4,
+                 flush_interval: float = 0.5, batch_size: int = 50,
+                 max_retries: int = 5, max_pending: int = 10000):
+        self.db_config = db_config
+        self.max_connections = max_connections
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.max_pending = max_pending
+        self._pool: Optional[ThreadedConnectionPool] = None
+        self._executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="lead-store")
+        self._pending_leads: Dict[str, tuple] = {}
+        self._pending_messages: List[tuple] = []
+        self._lead_state: Dict[str, tuple] = {}
+        self._failed_flushes = 0
+        self._dropping = False
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _get_pool(self) -> ThreadedConnectionPool:
+        if self._pool is None:
+            self._pool = ThreadedConnectionPool(1, self.max_connections, **self.db_config)
+        return self._pool
+
+    def start(self):
+        """
+            Starts the background flusher on the running event loop.
+        """
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def save(self, chat_id: str, lead_info: LeadInfo, conversion: bool,
+             turn_index: int, user_message: str, ai_message: str):
+        """
+            Queues one turn of a chat for writing, along with the lead row if it changed.
+
+            Args:
+                chat_id: The chat (session) id.
+                lead_info: The current lead information of the chat.
+                conversion: Whether the lead info is complete.
+                turn_index: The 0-based position of this turn in the conversation.
+                user_message: The user's message.
+                ai_message: The bot's reply.
+        """
+        self.save_lead(chat_id, lead_info, conversion)
+        self._pending_messages.append((chat_id, turn_index, user_message, ai_message))
+        self._trim()
+        if len(self._pending_messages) >= self.batch_size:
+            self._wake.set()
+
+    def save_lead(self, chat_id: str, lead_info: LeadInfo, conversion: bool):
+        """
+            Queues the lead row of a chat for writing if it changed, without a turn.
+        """
+        self.start()
+        lead = (lead_info.name, lead_info.email, lead_info.phone, conversion)
+        if self._lead_state.get(chat_id) != lead:
+            self._lead_state[chat_id] = lead
+            self._pending_leads[chat_id] = (chat_id, *lead)
+
+    def has_pending(self, chat_id: str) -> bool:
+        """
+            Whether writes of the chat are still queued.
+        """
+        return chat_id in self._pending_leads or any(row[0] == chat_id for row in self._pending_messages)
+
+    def _trim(self):
+        overflow = len(self._pending_messages) - self.max_pending
+        if overflow > 0:
+            del self._pending_messages[:overflow]
+            self._dropped(overflow, f"more than {self.max_pending} messages queued")
+
+    def _dropped(self, count: int, reason: str):
+        # Logged once per outage, the counter keeps the total
+        metrics.inc("db_dropped_writes", count)
+        if not self._dropping:
+            self._dropping = True
+            print(f"Dropping lead store writes ({reason}), more are dropped until a flush succeeds")
+
+    def forget(self, chat_id: str):
+        """
+            Drops the cached lead state of a chat that is no longer active.
+        """
+        self._lead_state.pop(chat_id, None)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self):
+        """
+            Writes every pending lead row and message in one transaction.
+        """
+        if not self._pending_leads and not self._pending_messages:
+            return
+        leads, self._pending_leads = self._pending_leads, {}
+        messages, self._pending_messages = self._pending_messages, []
+        loop = asyncio.get_running_loop()
+        try:
+            with metrics.span("db_write", rows=len(leads) + len(messages)):
+                await loop.run_in_executor(self._executor, self._write_batch, list(leads.values()), messages)
+        except Exception as e:
+            self._failed_flushes += 1
+            metrics.inc("db_errors")
+            if self._failed_flushes >= self.max_retries:
+                self._dropped(len(leads) + len(messages), f"{self._failed_flushes} failed flushes in a row: {e}")
+                # The lead rows are queued again with the chats' next turn
+                for chat_id in leads:
+                    self._lead_state.pop(chat_id, None)
+                return
+            print(f"Failed to store leads: {e}")
+            # Keep the writes for the next flush unless a newer lead state was queued meanwhile
+            for chat_id, row in leads.items():
+                self._pending_leads.setdefault(chat_id, row)
+            self._pending_messages[:0] = messages
+            self._trim()
+            return
+        self._failed_flushes = 0
+        self._dropping = False
+
+    def _write_batch(self, leads: List[tuple], messages: List[tuple]):
+        pool = self._get_pool()
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                # Lead rows first, chat_messages references chats
+                execute_batch(cur, UPSERT_LEAD, leads)
+                execute_batch(cur, INSERT_MESSAGE, [(*message, message[0]) for message in messages])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn)
+
+    def _read_transcript(self, chat_id: str) -> List[Dict]:
+        pool = self._get_pool()
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(SELECT_MESSAGES, (chat_id,))
+                rows = cur.fetchall()
+                if rows:
+                    return [{"user": user, "ai": ai} for user, ai in rows]
+                cur.execute(SELECT_LEGACY_CHAT, (chat_id,))
+                row = cur.fetchone()
+                if row is None or not row[0]:
+                    return []
+                return [{"user": turn.get("users", turn.get("user")), "ai": turn.get("ai")} for turn in row[0]]
+        finally:
+            conn.rollback()
+            pool.putconn(conn)
+
+    async def load_transcript(self, chat_id: str) -> List[Dict]:
+        """
+            Rebuilds the transcript of a chat as a list of {"user", "ai"} turns.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._read_transcript, chat_id)
+
+    def _read_lead(self, chat_id: str) -> Optional[Tuple[LeadInfo, bool]]:
+        pool = self._get_pool()
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(SELECT_LEAD, (chat_id,))
+                row = cur.fetchone()
+        finally:
+            conn.rollback()
+            pool.putconn(conn)
+        if row is None:
+            return None
+        name, email, phone, conversion = row
+        return LeadInfo(name=name, email=email, phone=phone), bool(conversion)
+
+    async def load_lead(self, chat_id: str) -> Optional[Tuple[LeadInfo, bool]]:
+        """
+            Returns the stored lead info and conversion flag of a chat, or None if it was never stored.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._read_lead, chat_id)
+
+    async def close(self):
+        """
+            Stops the flusher, writes everything still pending and closes the pool.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._pending_leads or self._pending_messages:
+            print(f"Dropping {len(self._pending_messages)} unsaved messages on shutdown")
+        self._executor.shutdown(wait=True)
+        if self._pool is not None:
+            self._pool.closeall()
+            self._pool = None
+
+class SQLiteLeadStore(LeadStore):
+    """
+        LeadStore writing to a local SQLite file instead of Postgres, with the same tables.
+        Meant for benchmarks and local development, where no database server is running.
+
+        Attributes:
+            path (str) : the SQLite database file.
+    """
+    def __init__(self, path: str, flush_interval: float = 0.5, batch_size: int = 50):
+        super().__init__(db_config={}, max_connections=1, flush_interval=flush_interval, batch_size=batch_size)
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS chats (
+                    id TEXT PRIMARY KEY,
+                    name TEXT,
+                    email TEXT,
+                    phone TEXT,
+                    conversion INTEGER,
+                    chat TEXT,
+                    last_updated TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_messages (
+                    chat_id TEXT NOT NULL REFERENCES chats (id) ON DELETE CASCADE,
+                    turn_index INTEGER NOT NULL,
+                    user_message TEXT,
+                    ai_message TEXT,
+                    PRIMARY KEY (chat_id, turn_index)
+                )
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _write_batch(self, leads: List[tuple], messages: List[tuple]):
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO chats (id, name, email, phone, conversion) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET name = COALESCE(excluded.name, name), "
+                "email = COALESCE(excluded.email, email), phone = COALESCE(excluded.phone, phone), "
+                "conversion = conversion OR excluded.conversion, last_updated = CURRENT_TIMESTAMP",
+                leads
+            )
+            conn.executemany(
+                "INSERT INTO chat_messages (chat_id, turn_index, user_message, ai_message) "
+                "SELECT ?, MAX(?, COALESCE(MAX(turn_index) + 1, 0)), ?, ? FROM chat_messages WHERE chat_id = ? "
+                "ON CONFLICT (chat_id, turn_index) DO NOTHING",
+                [(*message, message[0]) for message in messages]
+            )
+
+    def _read_transcript(self, chat_id: str) -> List[Dict]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT user_message, ai_message FROM chat_messages WHERE chat_id = ? ORDER BY turn_index",
+                (chat_id,)
+            ).fetchall()
+        return [{"user": user, "ai": ai} for user, ai in rows]
+
+    def _read_lead(self, chat_id: str) -> Optional[Tuple[LeadInfo, bool]]:
+        with self._connect() as conn:
+            row = conn.execute(SELECT_LEAD.replace("%s", "?"), (chat_id,)).fetchone()
+        if row is None:
+            return None
+        name, email, phone, conversion = row
+        return LeadInfo(name=name, email=email, phone=phone), bool(conversion)
+
+_lead_store = None
+
+def get_lead_store() -> LeadStore:
+    """
+        Returns the process-wide LeadStore, on Postgres or on SQLite with LEAD_STORE=sqlite.
+    """
+    global _lead_store
+    if _lead_store is None:
+        if os.getenv("LEAD_STORE", "postgres") == "sqlite":
+            _lead_store = SQLiteLeadStore(os.getenv("LEAD_SQLITE_PATH", "../leads.db"))
+        else:
+            _lead_store = LeadStore()
+    return _lead_store
@@ -4,9 +4,16 @@ from langchain.text_splitter import (
 )
 from langchain.schema import Document
 import re
-from typing import List, Dict
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Dict, Tuple
 import glob
 from tqdm import tqdm
+from topic_filter import topic_metadata
+
+# Number of parser processes, defaults to every core
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1)))
 
 
 def extract_metadata(md_content: str) -> Dict:
@@ -79,20 +86,50 @@ def process_immigration_doc(file_path: str) -> List[Document]:
         #             final_chunks.append(new_doc)
         # else:
         chunks = text_splitter.split_text(doc.page_content)
+        # topic_* flags from the tags and headers, so retrieval can filter by topic
+        chunk_metadata = {**doc.metadata, **metadata}
+        chunk_metadata.update(topic_metadata(chunk_metadata))
         for chunk in chunks:
             new_doc = Document(
                 page_content=chunk,
-                metadata={**doc.metadata, **metadata}
+                metadata=dict(chunk_metadata)
             )
             final_chunks.append(new_doc)
     
     return final_chunks
 
+def iter_processed_docs(md_files: List[str], workers: int = INGEST_WORKERS) -> Iterator[Tuple[str, List[Document]]]:
+    """
+        Parses and splits markdown files in a process pool and yields (file_path, chunks)
+        in the order of md_files.
+
+        At most 2 * workers files are in flight at once, so a slow consumer (embedding)
+        never lets parsed chunks of the whole corpus pile up in memory.
+    """
+    if workers <= 1:
+        for file_path in md_files:
+            yield file_path, process_immigration_doc(file_path)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        files = iter(md_files)
+        for file_path in files:
+            pending.append((file_path, pool.submit(process_immigration_doc, file_path)))
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            file_path, future = pending.popleft()
+            next_file = next(files, None)
+            if next_file is not None:
+                pending.append((next_file, pool.submit(process_immigration_doc, next_file)))
+            yield file_path, future.result()
+
 if __name__ == "__main__":
     md_files = glob.glob("../knowledge_base/*.md")
-    all_chunks = []
+    total_chunks = 0
     
-    for file_path in tqdm(md_files):
-        all_chunks.extend(process_immigration_doc(file_path))   
+    for file_path, chunks in tqdm(iter_processed_docs(md_files), total=len(md_files)):
+        total_chunks += len(chunks)
 
-    print(f"Processed {len(all_chunks)} chunks from {len(md_files)} files")
+    print(f"Processed {total_chunks} chunks from {len(md_files)} files")
@@ -0,0 +1,64 @@
+import asyncio
+import os
+from typing import Dict, List
+from answer_cache import is_standalone
+from llm_gateway import with_priority
+
+# How a referential question ("what about its salary?") is turned into a retrieval query:
+# heuristic prepends the earlier user questions it refers to, llm asks the model to
+# rewrite it (falling back to the heuristic), off retrieves on the question as is.
+QUERY_REWRITE = os.getenv("QUERY_REWRITE", "heuristic")
+QUERY_REWRITE_TIMEOUT = float(os.getenv("QUERY_REWRITE_TIMEOUT", "2.0"))
+MAX_CONTEXT_QUESTIONS = 2  # Earlier user questions a referential question may lean on
+
+def condense_heuristic(question: str, history: List[Dict]) -> str:
+    """
+        Prefixes the question with the user's previous questions, back to the last one
+        that stands on its own. Only user messages are used, never the AI answers or the
+        lead request boilerplate appended to them.
+    """
+    context = []
+    for turn in reversed(history[-MAX_CONTEXT_QUESTIONS:]):
+        context.insert(0, turn["user"])
+        if is_standalone(turn["user"]):
+            break
+    return " ".join([*context, question])
+
+def condense_prompt(question: str, history: List[Dict]) -> str:
+    questions = "\n".join(f"- {turn['user']}" for turn in history)
+    return f"""
+        Rewrite the follow-up question so it can be understood without the conversation.
+        Keep names of passes, visas, companies and numbers exactly as written.
+        Reply with the rewritten question only.
+
+        **Earlier questions**:
+        {questions}
+
+        **Follow-up question**: {question}
+
+        **Standalone question**:
+    """
+
+async def rewrite_query(question: str, history: List[Dict], llm=None, mode: str = QUERY_REWRITE) -> str:
+    """
+        Returns the query used for retrieval. The chat history only goes to the generation prompt.
+
+        Standalone questions (and every question when there is no history) are used as is.
+
+        Args:
+            question: the user's message.
+            history: the session's rolling history.
+            llm: the chat model, only used in llm mode.
+            mode: heuristic, llm or off.
+    """
+    if mode == "off" or not history or is_standalone(question):
+        return question
+    if mode == "llm" and llm is not None:
+        try:
+            response = await asyncio.wait_for(with_priority(llm, "rewrite").ainvoke(condense_prompt(question, history)), QUERY_REWRITE_TIMEOUT)
+            rewritten = response.content.strip()
+            if rewritten:
+                return rewritten
+        except Exception as e:
+            print(f"Query rewrite failed ({e!r}), using the heuristic")
+    return condense_heuristic(question, history)
@@ -1,26 +1,55 @@
 from langchain_community.vectorstores import Chroma
-from langchain_community.llms import Ollama
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
-from langchain_google_genai import ChatGoogleGenerativeAI  # Or your preferred LLM
+from langchain_core.runnables import RunnableLambda
+from operator import itemgetter
+import asyncio
 import os
+import threading
+import time
+from contextlib import aclosing, contextmanager
+from typing import AsyncIterator, List, Dict, Optional, Tuple
 from dotenv import load_dotenv
+from answer_cache import create_answer_cache
+from context_builder import build_context, count_tokens
+from fallback_predictor import FALLBACK_MODE, predicts_fallback, record_turn, retrieval_confidence
+from embeddings import get_embeddings
+from embedding_service import create_query_embeddings
+from index_versions import current_version, version_dir
+from metrics import metrics, prefixed
+from lexical_index import HybridRetriever, load_lexical_index
+from topic_filter import load_topic_index
+from llm_gateway import with_priority
+from llm_providers import create_llm
+from mmap_store import VECTORS_FILE, MmapVectorStore
 
 load_dotenv()
 
+# Configuration
+VECTOR_STORE = os.getenv("VECTOR_STORE", "chroma")  # chroma, or mmap for the memory-mapped exact-search store
+INDEX_WATCH_INTERVAL = float(os.getenv("INDEX_WATCH_INTERVAL", "30"))  # 0 disables the watcher
+PROMPT_TOKEN_BUCKETS = [250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000]  # Sizes of the RAG prompts
+
 # 1. Load Vector Store
-def load_vector_store():
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+def load_vector_store(embeddings=None, persist_directory: Optional[str] = None):
+    if embeddings is None:
+        embeddings = get_embeddings()
+    if persist_directory is None:
+        persist_directory = version_dir(current_version())
+    if VECTOR_STORE == "mmap":
+        if os.path.exists(os.path.join(persist_directory, VECTORS_FILE)):
+            vector_db = MmapVectorStore.load(persist_directory, embeddings)
+            print(f"Loaded memory-mapped vector store with {vector_db.count()} documents")
+            return vector_db
+        print(f"No {VECTORS_FILE} in {persist_directory}, using Chroma")
     vector_db = Chroma(
-        persist_directory="../incorp_db",
+        persist_directory=persist_directory,
         embedding_function=embeddings
     )
     print(f"Loaded vector store with {vector_db._collection.count()} documents")
     return vector_db
 
 # 2. Create RAG Chain
-def create_rag_chain(vector_db):
+def create_prompt():
     # Define prompt template
     prompt_template = """
         you are an ai assistant for incorp asia (business solutions: immigration, incorporation, tax, compliance, etc.).
@@ -36,6 +65,9 @@ def create_rag_chain(vector_db):
         **Context:**
         {context}
 
+        **Chat History:**
+        {chat_history}
+
         **Question:** {question}
 
         **Answer:**
@@ -50,14 +82,36 @@ def create_rag_chain(vector_db):
 
         **Answer:**
     """    
-    prompt = ChatPromptTemplate.from_template(prompt_template)
-    
+    return ChatPromptTemplate.from_template(prompt_template)
+
+def create_retriever(vector_db, lexical_index=None, topic_index=None):
+    # Vector + BM25 candidates fused with RRF, so 5 chunks do what 12 MMR chunks did,
+    # both restricted to the question's topics when the index version has a topic index
+    return HybridRetriever(vector_db=vector_db, lexical_index=lexical_index, topic_index=topic_index)
+
+def turn_input(query) -> Dict:
+    """
+        Accepts a plain question as chain input, with no history and retrieval on the question itself.
+    """
+    if isinstance(query, str):
+        return {"question": query, "retrieval_query": query, "chat_history": ""}
+    return query
+
+def record_prompt_tokens(prompt_value):
+    """
+        Records the size of every RAG prompt sent to the llm in the prompt_tokens histogram
+        and passes it through.
+    """
+    metrics.record("prompt_tokens", count_tokens(prompt_value.to_string()), PROMPT_TOKEN_BUCKETS)
+    return prompt_value
+
+def create_rag_chain(vector_db, llm=None, retriever=None, prompt=None):
+    if prompt is None:
+        prompt = create_prompt()
+
     # Initialize LLM (replace with your API key)
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-2.0-flash",
-        temperature=0.6,
-        google_api_key=os.getenv("GOOGLE_API_KEY")
-    )
+    if llm is None:
+        llm = create_llm()
     # REPLACE Gemini with Ollama (pointing to your Docker service)
     # llm = Ollama(
     #     model="llama3.1",
@@ -65,25 +119,363 @@ def create_rag_chain(vector_db):
     #     temperature=0.6,
     #     # num_gpu=20  # Adjust based on your GPU capacity
     # )
+    # Answers get the highest priority in the llm gateway
+    llm = with_priority(llm, "answer")
     
     # Create retrieval chain
-    retriever = vector_db.as_retriever(
-        search_type = "mmr",
-        search_kwargs={"k": 12, "fetch_k": 20}
-    )
+    if retriever is None:
+        retriever = create_retriever(vector_db)
     
+    # Chunks already retrieved by the caller (to predict a fallback) aren't retrieved again
+    def retrieve(inputs: Dict):
+        if inputs.get("documents") is not None:
+            return inputs["documents"]
+        return retriever.invoke(inputs["retrieval_query"])
+
+    async def aretrieve(inputs: Dict):
+        if inputs.get("documents") is not None:
+            return inputs["documents"]
+        return await retriever.ainvoke(inputs["retrieval_query"])
+
+    # Retrieval only sees the (rewritten) question, the history only goes to the prompt.
+    # The chunks go through the token-budgeted context builder instead of their repr.
     rag_chain = (
-        {"context": retriever, "question": RunnablePassthrough()}
+        RunnableLambda(turn_input)
+        | {
+            "context": RunnableLambda(retrieve, afunc=aretrieve) | build_context,
+            "question": itemgetter("question"),
+            "chat_history": itemgetter("chat_history")
+        }
         | prompt
+        | RunnableLambda(record_prompt_tokens)
         | llm
     )
     
     return rag_chain
 
-# 3. Test Function
+# 3. Shared Engine
+class RAGEngine:
+    """
+        The process-wide retrieval engine that is shared by every chat session.
+
+        Loading the embedding model, opening the Chroma store and creating the LLM client
+        are expensive, so they are done once per process instead of once per session.
+        The objects held here are read-only after construction, sessions only keep
+        their own history and lead capture state.
+
+        An engine is bound to one index version. When a new version is published a new
+        engine is built next to it and swapped in (see reload_engine), turns that leased
+        the old engine finish on it and it is closed once the last one is done.
+
+        Attributes:
+            version (str) : the index version this engine reads, None for the legacy index.
+            embeddings : the batched, cached query embeddings (see embedding_service) over the
+                embedding model from embeddings.get_embeddings.
+            vector_db : the persisted knowledge base, Chroma or a MmapVectorStore (VECTOR_STORE).
+            lexical_index (LexicalIndex) : the BM25 index of the same chunks, None for a legacy index.
+            topic_index (TopicIndex) : maps questions to topic filters, None for a legacy index.
+            retriever : the hybrid (vector + BM25) retriever.
+            prompt (ChatPromptTemplate) : the RAG prompt.
+            llm : the chat model shared by the RAG chain, lead capture and fallback, each
+                calls it through the llm gateway with its own priority.
+            rag_chain : the complete retrieval + generation chain.
+            answer_cache (SemanticAnswerCache) : cached answers to standalone questions, or None.
+            warmup_seconds (float) : how long the engine took to build.
+    """
+    def __init__(self, version: Optional[str] = None, embeddings=None, llm=None):
+        start = time.perf_counter()
+        self.version = version
+        if embeddings is None:
+            # EMBEDDING_BACKEND picks torch, onnx or onnx-int8
+            embeddings = get_embeddings()
+            # Force the model weights to load now instead of on the first user query
+            embeddings.embed_query("warmup")
+        # Query embeddings are batched across sessions and cached (see embedding_service)
+        self.embeddings = create_query_embeddings(embeddings)
+        self.vector_db = load_vector_store(self.embeddings, version_dir(version))
+        self.lexical_index = load_lexical_index(version_dir(version))
+        self.topic_index = load_topic_index(version_dir(version))
+        self.retriever = create_retriever(self.vector_db, self.lexical_index, self.topic_index)
+        self.prompt = create_prompt()
+        self.llm = llm if llm is not None else create_llm()
+        self.rag_chain = create_rag_chain(
+            self.vector_db, llm=self.llm, retriever=self.retriever, prompt=self.prompt
+        )
+        # Bound to this engine's version, the engine of the next version starts with an empty cache
+        self.answer_cache = create_answer_cache(version)
+        self.leases = 0
+        self.retired = False
+        self.warmup_seconds = time.perf_counter() - start
+        print(f"RAG engine (index {version or 'legacy'}) warmed up in {self.warmup_seconds:.2f}s")
+
+    def close(self):
+        """
+            Releases the Chroma client of a retired engine so its memory can be freed.
+        """
+        if isinstance(self.vector_db, MmapVectorStore):
+            self.vector_db.close()
+            print(f"Released index {self.version or 'legacy'}")
+            return
+        try:
+            from chromadb.api.shared_system_client import SharedSystemClient
+            client = self.vector_db._client
+            system = client._system
+            SharedSystemClient._identifier_to_system.pop(client._identifier, None)
+            system.stop()
+        except Exception as e:
+            print(f"Failed to close index {self.version}: {e}")
+        print(f"Released index {self.version or 'legacy'}")
+
+_engine = None
+_engine_lock = threading.Lock()
+_reload_lock = None
+
+def get_engine() -> RAGEngine:
+    """
+        Returns the process-wide RAGEngine, building it on the first call.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = RAGEngine(current_version())
+    return _engine
+
+def _cache_gauges() -> Dict:
+    if _engine is None or _engine.answer_cache is None:
+        return {}
+    return prefixed("answer_cache", _engine.answer_cache.stats())
+
+metrics.register_collector(_cache_gauges)
+
+@contextmanager
+def lease_engine():
+    """
+        Holds on to the current engine for the length of a turn, so a reload in the
+        middle of the turn doesn't close the index it is reading.
+    """
+    engine = get_engine()
+    engine.leases += 1
+    try:
+        yield engine
+    finally:
+        engine.leases -= 1
+        if engine.retired and engine.leases == 0:
+            engine.close()
+
+async def reload_engine() -> bool:
+    """
+        Switches to the published index version if it changed.
+
+        The new engine is built in a worker thread, reusing the embedding model and the llm,
+        while turns keep being served by the old one. New turns then pick up the new engine.
+        Returns True if a new version was loaded.
+    """
+    global _engine, _reload_lock
+    if _reload_lock is None:
+        _reload_lock = asyncio.Lock()
+    async with _reload_lock:
+        old = get_engine()
+        version = current_version()
+        if version == old.version:
+            return False
+        new = await asyncio.to_thread(RAGEngine, version, old.embeddings, old.llm)
+        _engine = new
+        old.retired = True
+        if old.leases == 0:
+            old.close()
+        print(f"Switched from index {old.version or 'legacy'} to {version}")
+        return True
+
+async def watch_index(interval: float = INDEX_WATCH_INTERVAL):
+    """
+        Polls the CURRENT pointer and reloads the engine when a new index is published.
+    """
+    if interval <= 0:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reload_engine()
+        except Exception as e:
+            print(f"Index reload failed: {e}")
+
+# 4. Fallback and Streaming
+FALLBACK_SENTINEL = "<SERVICE_FALLBACK>"
+
+def fallback_prompt(question: str) -> str:
+    return f"""
+        **Role**: You are the Fallback Specialist for InCorp Asia's chatbot. 
+        The main AI couldn't answer this query about our services.
+
+        **Current Query That Needs Fallback**:
+        "{question}"
+
+        **Your Task**:
+        1. Provide a GENERAL but helpful response on the basis of the prompts provided.
+        2. Never say "according to your documents" or "in the context"
+        3. Just provide a good reply to the query dont respond with something staring with "Okay i understand".
+ 
+        `Note: we donot have the service of connecting to specialists of the company so dont mention that`
+
+        **Answer**:
+    """
+
+async def fall_back(history: List[Dict], question: str, llm):
+    response = await with_priority(llm, "answer").ainvoke(fallback_prompt(question))
+    return response
+
+def _releasable_length(text: str) -> int:
+    """
+        Returns how much of text can be shown to the user, holding back any
+        trailing characters that could be the beginning of FALLBACK_SENTINEL.
+    """
+    for size in range(min(len(text), len(FALLBACK_SENTINEL) - 1), 0, -1):
+        if text.endswith(FALLBACK_SENTINEL[:size]):
+            return len(text) - size
+    return len(text)
+
+class _EarlyFallback:
+    """
+        Fallback answer generated in the background while the RAG chain is still running.
+    """
+    def __init__(self, llm, question: str):
+        self.started = time.monotonic()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run(llm, question))
+
+    async def _run(self, llm, question: str):
+        try:
+            async with aclosing(llm.astream(fallback_prompt(question))) as stream:
+                async for chunk in stream:
+                    if chunk.content:
+                        self.queue.put_nowait(chunk.content)
+        finally:
+            self.queue.put_nowait(None)
+
+    async def tokens(self) -> AsyncIterator[str]:
+        while (token := await self.queue.get()) is not None:
+            yield token
+        # Surfaces a failed fallback call
+        await self.task
+
+    def cancel(self):
+        self.task.cancel()
+
+async def stream_answer(rag_chain, llm, question: str, chat_history: str,
+                        retrieval_query: Optional[str] = None, documents=None) -> AsyncIterator[Tuple[str, str]]:
+    """
+        Streams the answer for one turn as (event, text) tuples.
+
+        The RAG answer is streamed as "token" events. Text that could be the start of
+        the <SERVICE_FALLBACK> sentinel is held back, so when the sentinel shows up the
+        fallback answer is streamed instead without the user seeing it. If some RAG text
+        was already released before the sentinel, a "reset" event tells the caller to
+        discard what it has shown so far. A "fallback" event marks the switch.
+
+        When the chunks are passed in, their retrieval scores predict whether the chain
+        will fall back. Depending on FALLBACK_MODE a predicted fallback is only logged
+        (off), answered by the fallback llm without running the chain (replace), or the
+        fallback starts right away next to the chain and whichever is not needed is
+        cancelled (race).
+
+        Args:
+            rag_chain: the RAG chain to stream from.
+            llm: the chat model used for the fallback answer.
+            question: the user's message on its own.
+            chat_history: the formatted chat history, only used in the prompt.
+            retrieval_query: the query the chunks are retrieved with, the question by default.
+            documents: the already retrieved chunks, the chain retrieves them if None.
+    """
+    llm = with_priority(llm, "answer")
+    query = {
+        "question": question,
+        "retrieval_query": retrieval_query or question,
+        "chat_history": chat_history,
+        "documents": documents
+    }
+    start = time.monotonic()
+    confidence = retrieval_confidence(documents) if documents is not None else None
+    predicted = predicts_fallback(confidence)
+    record = {
+        "question": question,
+        "retrieval_query": query["retrieval_query"],
+        "confidence": confidence,
+        "predicted": predicted,
+        "mode": FALLBACK_MODE,
+        "fell_back": None,
+        "outcome": "answered"
+    }
+    early = None
+    try:
+        if predicted and FALLBACK_MODE == "replace":
+            record["outcome"] = "replaced"
+            yield "fallback", ""
+            async with aclosing(llm.astream(fallback_prompt(question))) as stream:
+                async for chunk in stream:
+                    if chunk.content:
+                        yield "token", chunk.content
+            metrics.observe("fallback", time.monotonic() - start, outcome="replaced")
+            return
+        if predicted and FALLBACK_MODE == "race":
+            early = _EarlyFallback(llm, question)
+
+        text = ""
+        sent = 0
+        # Closed explicitly when breaking out on the sentinel, so the chain's llm call (and
+        # its gateway slot) is released right away instead of whenever it's garbage collected
+        async with aclosing(rag_chain.astream(query)) as stream:
+            async for chunk in stream:
+                if not text:
+                    metrics.observe("generation_first_token", time.monotonic() - start)
+                text += chunk.content
+                if FALLBACK_SENTINEL in text:
+                    break
+                releasable = _releasable_length(text)
+                if releasable > sent:
+                    if early is not None:
+                        # The chain is answering, the early fallback lost
+                        early.cancel()
+                        early = None
+                        record["outcome"] = "race_cancelled"
+                    yield "token", text[sent:releasable]
+                    sent = releasable
+            else:
+                record["fell_back"] = False
+                if sent < len(text):
+                    yield "token", text[sent:]
+                metrics.observe("generation", time.monotonic() - start)
+                return
+
+        # The RAG chain couldn't answer, switch to the fallback llm
+        record["fell_back"] = True
+        record["sentinel_seconds"] = round(time.monotonic() - start, 3)
+        metrics.observe("generation", time.monotonic() - start, outcome="fallback")
+        fallback_start = time.monotonic()
+        if sent:
+            yield "reset", ""
+        yield "fallback", ""
+        if early is not None:
+            record["outcome"] = "race_won"
+            record["head_start_seconds"] = round(time.monotonic() - early.started, 3)
+            async for token in early.tokens():
+                yield "token", token
+            early = None
+        else:
+            async with aclosing(llm.astream(fallback_prompt(question))) as stream:
+                async for chunk in stream:
+                    if chunk.content:
+                        yield "token", chunk.content
+        metrics.observe("fallback", time.monotonic() - fallback_start)
+    finally:
+        if early is not None:
+            early.cancel()
+        record["seconds"] = round(time.monotonic() - start, 3)
+        record_turn(record)
+
+# 5. Test Function
 def test_rag():
-    vector_db = load_vector_store()
-    rag_chain = create_rag_chain(vector_db)
+    rag_chain = get_engine().rag_chain
     
     while True:
         question = input("\n Question:")
@@ -0,0 +1,340 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+from conversation_memory import new_memory, remember_turn
+from lead_capture import LeadCapture
+from session_store import SessionStore
+
+def serialize_session(session: Dict) -> str:
+    """
+        Turns a live session into JSON. Only per-session data is kept, no LLM objects.
+    """
+    return json.dumps({
+        "history": session["history"],
+        "unsummarized": session.get("unsummarized", []),
+        "summary": session.get("summary", ""),
+        "full_history": session["full_history"],
+        "turns": session["turns"],
+        "lead_capture": session["lead_capture"].to_dict(),
+        "created_at": session["created_at"].isoformat()
+    })
+
+def deserialize_session(data: str, llm) -> Dict:
+    """
+        Rebuilds a live session from serialize_session output, attaching the shared llm.
+    """
+    state = json.loads(data)
+    return {
+        "history": state["history"],
+        "unsummarized": state.get("unsummarized", []),
+        "summary": state.get("summary", ""),
+        "full_history": state["full_history"],
+        "turns": state["turns"],
+        "lead_capture": LeadCapture.from_dict(state["lead_capture"], llm),
+        "created_at": datetime.fromisoformat(state["created_at"])
+    }
+
+class SessionBackend(ABC):
+    """
+        Where bot_api keeps its chat sessions between turns.
+
+        get() returns a live session dict (or None), put() stores it after every turn.
+        Backends that live outside the process let any uvicorn worker or replica serve any
+        turn of a session. Concurrent turns of the same session are last-write-wins, which
+        matches a client that waits for each reply before sending the next message.
+    """
+    @abstractmethod
+    async def get(self, session_id: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    async def put(self, session_id: str, session: Dict):
+        ...
+
+    @abstractmethod
+    async def delete(self, session_id: str):
+        ...
+
+    async def evict_expired(self):
+        pass
+
+    @abstractmethod
+    async def stats(self) -> Dict:
+        ...
+
+class ExternalSessionBackend(SessionBackend):
+    """
+        Base of the backends storing serialized sessions outside the process. Like the
+        SessionStore, an expired or unknown session is rebuilt through on_restore (from
+        the stored lead and transcript) and on_evict is called for every expired session.
+
+        Attributes:
+            idle_ttl (float) : seconds of inactivity before a session is deleted.
+            get_llm : callable returning the llm to attach to loaded sessions.
+            on_restore : optional coroutine function(session_id) returning a session to
+                restore for an unknown session id, or None.
+            on_evict : optional callable(session_id, session) called for every expired
+                session. The session is None, expired sessions aren't loaded.
+    """
+    def __init__(self, idle_ttl: float, get_llm: Callable,
+                 on_restore: Optional[Callable[[str], Awaitable[Optional[Dict]]]] = None,
+                 on_evict: Optional[Callable[[str, Optional[Dict]], None]] = None):
+        self.idle_ttl = idle_ttl
+        self.get_llm = get_llm
+        self.on_restore = on_restore
+        self.on_evict = on_evict
+
+    @abstractmethod
+    async def _load(self, session_id: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    async def _delete_expired(self) -> List[str]:
+        ...
+
+    async def get(self, session_id: str) -> Optional[Dict]:
+        state = await self._load(session_id)
+        if state:
+            return deserialize_session(state, self.get_llm())
+        if self.on_restore is None:
+            return None
+        try:
+            session = await self.on_restore(session_id)
+        except Exception as e:
+            print(f"Failed to restore session {session_id}: {e}")
+            return None
+        if session is not None:
+            await self.put(session_id, session)
+        return session
+
+    async def evict_expired(self):
+        for session_id in await self._delete_expired():
+            if self.on_evict is not None:
+                try:
+                    self.on_evict(session_id, None)
+                except Exception as e:
+                    print(f"Session evict hook failed for {session_id}: {e}")
+
+class InMemorySessionBackend(SessionBackend):
+    """
+        Keeps sessions in the bounded SessionStore of this process. Only valid with a single worker.
+    """
+    def __init__(self, store: SessionStore):
+        self.store = store
+
+    async def get(self, session_id: str) -> Optional[Dict]:
+        return await self.store.get(session_id)
+
+    async def put(self, session_id: str, session: Dict):
+        if session_id not in self.store:
+            self.store.add(session_id, session)
+
+    async def delete(self, session_id: str):
+        self.store.remove(session_id)
+
+    async def evict_expired(self):
+        self.store.evict_expired()
+
+    async def stats(self) -> Dict:
+        return {"backend": "memory", **self.store.stats()}
+
+class SQLiteSessionBackend(ExternalSessionBackend):
+    """
+        Stores serialized sessions in a SQLite file shared by all workers on one node.
+
+        Attributes:
+            path (str) : the SQLite database file.
+    """
+    def __init__(self, path: str, idle_ttl: float, get_llm: Callable, on_restore=None, on_evict=None):
+        super().__init__(idle_ttl, get_llm, on_restore, on_evict)
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_sessions (
+                    id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        # One short-lived connection per call, sqlite3 connections can't be shared across threads
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _get(self, session_id: str) -> Optional[str]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT state FROM chat_sessions WHERE id = ? AND updated_at > ?",
+                (session_id, time.time() - self.idle_ttl)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _put(self, session_id: str, state: str):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO chat_sessions (id, state, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                (session_id, state, time.time())
+            )
+
+    def _delete(self, session_id: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
+
+    async def _load(self, session_id: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get, session_id)
+
+    async def put(self, session_id: str, session: Dict):
+        await asyncio.to_thread(self._put, session_id, serialize_session(session))
+
+    async def delete(self, session_id: str):
+        await asyncio.to_thread(self._delete, session_id)
+
+    def _evict_expired(self) -> List[str]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "DELETE FROM chat_sessions WHERE updated_at <= ? RETURNING id", (time.time() - self.idle_ttl,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def _stats(self) -> Dict:
+        with self._connect() as conn:
+            count, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(state)), 0) FROM chat_sessions").fetchone()
+        return {"backend": "sqlite", "live_sessions": count, "approx_bytes": size}
+
+    async def _delete_expired(self) -> List[str]:
+        return await asyncio.to_thread(self._evict_expired)
+
+    async def stats(self) -> Dict:
+        return await asyncio.to_thread(self._stats)
+
+class PostgresSessionBackend(ExternalSessionBackend):
+    """
+        Stores serialized sessions in the chat_sessions table so every replica can serve any turn.
+    """
+    def __init__(self, db_config: Dict, idle_ttl: float, get_llm: Callable, max_connections: int = 4,
+                 on_restore=None, on_evict=None):
+        from psycopg2.pool import ThreadedConnectionPool
+        super().__init__(idle_ttl, get_llm, on_restore, on_evict)
+        self._pool = ThreadedConnectionPool(1, max_connections, **db_config)
+
+    def _execute(self, query: str, params: tuple, fetch: bool = False, fetch_all: bool = False):
+        conn = self._pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                row = cur.fetchall() if fetch_all else cur.fetchone() if fetch else None
+            conn.commit()
+            return row
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._pool.putconn(conn)
+
+    async def _load(self, session_id: str) -> Optional[str]:
+        row = await asyncio.to_thread(
+            self._execute,
+            "SELECT state::text FROM chat_sessions WHERE id = %s AND updated_at > NOW() - make_interval(secs => %s)",
+            (session_id, self.idle_ttl), True
+        )
+        return row[0] if row else None
+
+    async def put(self, session_id: str, session: Dict):
+        await asyncio.to_thread(
+            self._execute,
+            """
+                INSERT INTO chat_sessions (id, state) VALUES (%s, %s)
+                ON CONFLICT (id) DO UPDATE SET state = EXCLUDED.state, updated_at = NOW()
+            """,
+            (session_id, serialize_session(session))
+        )
+
+    async def delete(self, session_id: str):
+        await asyncio.to_thread(self._execute, "DELETE FROM chat_sessions WHERE id = %s", (session_id,))
+
+    async def _delete_expired(self) -> List[str]:
+        rows = await asyncio.to_thread(
+            self._execute,
+            "DELETE FROM chat_sessions WHERE updated_at <= NOW() - make_interval(secs => %s) RETURNING id",
+            (self.idle_ttl,), fetch_all=True
+        )
+        return [row[0] for row in rows]
+
+    async def stats(self) -> Dict:
+        count, size = await asyncio.to_thread(
+            self._execute,
+            "SELECT COUNT(*), COALESCE(SUM(pg_column_size(state)), 0) FROM chat_sessions", (), True
+        )
+        return {"backend": "postgres", "live_sessions": count, "approx_bytes": int(size)}
+
+def create_session_backend(store: SessionStore, get_llm: Callable) -> SessionBackend:
+    """
+        Picks the session backend from the SESSION_BACKEND environment variable
+        (memory, sqlite or postgres). The external backends take the store's idle_ttl and
+        its restore and evict hooks, only the in-memory backend keeps sessions in it.
+    """
+    backend = os.getenv("SESSION_BACKEND", "memory")
+    if backend == "sqlite":
+        return SQLiteSessionBackend(os.getenv("SESSION_SQLITE_PATH", "../sessions.db"), store.idle_ttl, get_llm,
+                                    on_restore=store.on_restore, on_evict=store.on_evict)
+    if backend == "postgres":
+        from persistence import DB_CONFIG
+        return PostgresSessionBackend(DB_CONFIG, store.idle_ttl, get_llm,
+                                      on_restore=store.on_restore, on_evict=store.on_evict)
+    return InMemorySessionBackend(store)
+
+# Multi-worker check: every turn of a session is served by a different process
+def _serve_turn(path: str, session_id: str, turn: int) -> int:
+    backend = SQLiteSessionBackend(path, idle_ttl=3600, get_llm=lambda: None)
+
+    async def serve():
+        session = await backend.get(session_id)
+        if session is None:
+            session = {**new_memory(), "full_history": [], "turns": 0,
+                       "lead_capture": LeadCapture(None), "created_at": datetime.now()}
+        lead_capture = session["lead_capture"]
+        lead_capture.increment_question()
+        if turn == 1:
+            lead_capture._apply_extracted({"name": "Worker Test", "email": f"{session_id}@example.com"})
+        remember_turn(session, f"q{turn}", f"a{turn}")
+        session["full_history"].append({"users": f"q{turn}", "ai": f"a{turn}"})
+        session["turns"] += 1
+        await backend.put(session_id, session)
+
+    asyncio.run(serve())
+    return os.getpid()
+
+def check_multiworker(workers: int = 4, sessions: int = 20, turns: int = 6):
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+
+    path = os.path.join(tempfile.mkdtemp(), "sessions.db")
+    SQLiteSessionBackend(path, idle_ttl=3600, get_llm=lambda: None)
+    pids = set()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for turn in range(turns):
+            # A client waits for each reply, so turns of one session are sequential
+            # but may land on any worker
+            futures = [pool.submit(_serve_turn, path, f"s{i}", turn) for i in range(sessions)]
+            pids.update(f.result() for f in futures)
+
+    backend = SQLiteSessionBackend(path, idle_ttl=3600, get_llm=lambda: None)
+    for i in range(sessions):
+        session = asyncio.run(backend.get(f"s{i}"))
+        lead_capture = session["lead_capture"]
+        assert session["turns"] == turns, session
+        assert lead_capture.questions_asked == turns
+        assert lead_capture.info_captured and lead_capture.lead_info.email == f"s{i}@example.com"
+        assert [h["user"] for h in session["unsummarized"] + session["history"]] == [f"q{t}" for t in range(turns)]
+        assert len(session["full_history"]) == turns
+    print(f"{sessions} sessions x {turns} turns consistent across {len(pids)} worker processes")
+
+if __name__ == "__main__":
+    check_multiworker()
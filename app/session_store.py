@@ -0,0 +1,137 @@
+import sys
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+
+class SessionStore:
+    """
+        A bounded in-memory store for chat sessions.
+
+        Sessions are kept in least-recently-used order. A session is evicted when it has
+        been idle for longer than idle_ttl seconds, or when the store is full and it is the
+        least recently used one. full_history is capped at max_history turns.
+
+        Attributes:
+            max_sessions (int) : maximum number of live sessions.
+            idle_ttl (float) : seconds of inactivity before a session is evicted.
+            max_history (int) : maximum number of turns kept in full_history.
+            on_evict : optional callable(session_id, session) called for every evicted session.
+            on_restore : optional coroutine function(session_id) returning a session to
+                restore for an unknown session id, or None.
+    """
+    def __init__(self, max_sessions: int = 10000, idle_ttl: float = 3600, max_history: int = 50,
+                 on_evict: Optional[Callable[[str, Dict], None]] = None,
+                 on_restore: Optional[Callable[[str], Awaitable[Optional[Dict]]]] = None):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_history = max_history
+        self.on_evict = on_evict
+        self.on_restore = on_restore
+        self._sessions: "OrderedDict[str, Dict]" = OrderedDict()
+        self.evictions = {"idle": 0, "capacity": 0}
+        self.restored = 0
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    async def get(self, session_id: str) -> Optional[Dict]:
+        """
+            Returns a live session and marks it as recently used, restoring it through
+            on_restore if it's not in memory.
+        """
+        self.evict_expired()
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session["last_active"] = time.monotonic()
+            self._sessions.move_to_end(session_id)
+            return session
+
+        if self.on_restore is None:
+            return None
+        try:
+            session = await self.on_restore(session_id)
+        except Exception as e:
+            print(f"Failed to restore session {session_id}: {e}")
+            return None
+        if session is not None:
+            self.restored += 1
+            self.add(session_id, session)
+        return session
+
+    def add(self, session_id: str, session: Dict):
+        """
+            Adds a session, evicting the least recently used ones if the store is full.
+        """
+        session["last_active"] = time.monotonic()
+        self._sessions[session_id] = session
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            oldest_id = next(iter(self._sessions))
+            self._evict(oldest_id, "capacity")
+
+    def remove(self, session_id: str):
+        """
+            Drops a session without calling the eviction hook.
+        """
+        self._sessions.pop(session_id, None)
+
+    def trim_history(self, session: Dict):
+        """
+            Caps full_history at max_history turns.
+        """
+        if len(session["full_history"]) > self.max_history:
+            session["full_history"] = session["full_history"][-self.max_history:]
+
+    def evict_expired(self):
+        """
+            Evicts every session idle for longer than idle_ttl.
+        """
+        cutoff = time.monotonic() - self.idle_ttl
+        # Sessions are in LRU order, so the idle ones are at the front
+        while self._sessions:
+            oldest_id, oldest = next(iter(self._sessions.items()))
+            if oldest["last_active"] > cutoff:
+                break
+            self._evict(oldest_id, "idle")
+
+    def _evict(self, session_id: str, reason: str):
+        session = self._sessions.pop(session_id)
+        self.evictions[reason] += 1
+        if self.on_evict is not None:
+            try:
+                self.on_evict(session_id, session)
+            except Exception as e:
+                print(f"Session evict hook failed for {session_id}: {e}")
+
+    def approx_bytes(self) -> int:
+        """
+            Roughly estimates the memory held by the live sessions.
+        """
+        return sum(_approx_size(session) for session in self._sessions.values())
+
+    def stats(self) -> Dict:
+        return {
+            "live_sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "approx_bytes": self.approx_bytes(),
+            "evictions": dict(self.evictions),
+            "restored": self.restored
+        }
+
+def _approx_size(obj) -> int:
+    """
+        Recursively sums sys.getsizeof over dicts, lists and the attributes of objects.
+        Shared objects like the LLM client are skipped by only following plain data.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_approx_size(key) + _approx_size(value) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_approx_size(item) for item in obj)
+    elif hasattr(obj, "lead_info"):
+        # LeadCapture: only count the per-session lead data, not the shared llm
+        size += _approx_size(obj.lead_info.model_dump())
+    return size
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+from lexical_index import iter_stored, tokenize
+
+# Configuration
+TOPIC_INDEX_FILE = "topic_index.json"  # Kept inside the index version dir, next to Chroma
+TOPIC_FILTER = os.getenv("TOPIC_FILTER", "1") == "1"  # 0 always searches the whole knowledge base
+TOPIC_MIN_CHUNKS = int(os.getenv("TOPIC_MIN_CHUNKS", "30"))  # Fewer matching chunks widens to everything
+LEARNED_TERM_WEIGHT = 0.5  # A learned term counts half as much as a seed phrase
+LEARNED_TERM_PURITY = 0.8  # Share of a term's chunks that must be in one topic for it to count
+GENERAL_TOPIC = "general"  # Chunks that match no topic, always searched
+
+# Seed phrases per topic, matched against the tags, headers and file name of every chunk at
+# ingestion and against the question at query time. The index learns more terms from the tags
+# and headers of the chunks each topic ends up with.
+TOPICS = {
+    "work_pass": [
+        "employment pass", "ep", "s pass", "work permit", "entrepass", "personal employment pass",
+        "one pass", "compass", "tech pass", "dependant pass", "dependant's pass", "dependent pass",
+        "long term visit pass", "ltvp", "work pass", "work visa", "training employment pass",
+        "work holiday", "ministry of manpower"
+    ],
+    "pr": [
+        "permanent resident", "permanent residence", "pr", "citizenship", "citizen",
+        "re entry permit", "global investor programme", "gip", "ica"
+    ],
+    "incorporation": [
+        "incorporate", "incorporation", "incorporating", "company registration", "register company",
+        "private limited", "pte ltd", "acra", "bizfile", "company secretary", "local director",
+        "nominee director", "registered address", "sole proprietorship", "branch office",
+        "representative office", "subsidiary"
+    ],
+    "tax": [
+        "tax", "taxes", "gst", "iras", "corporate tax", "income tax", "withholding tax",
+        "tax residency", "double taxation", "dta"
+    ],
+    "compliance": [
+        "annual return", "agm", "annual general meeting", "accounting", "bookkeeping", "audit",
+        "xbrl", "financial statements", "compliance", "payroll", "cpf"
+    ]
+}
+# Changes whenever the topics do, so the knowledge base is re-tagged (see create_embeddings)
+TOPIC_SCHEMA = hashlib.sha1(json.dumps(TOPICS, sort_keys=True).encode()).hexdigest()[:12]
+
+def topic_field(topic: str) -> str:
+    return f"topic_{topic}"
+
+def _padded(text: str) -> str:
+    # Token sequence with spaces around it, so phrases only match whole tokens
+    return f" {' '.join(tokenize(text))} "
+
+SEED_PHRASES = {topic: [_padded(phrase) for phrase in phrases] for topic, phrases in TOPICS.items()}
+
+def _matched_phrases(text: str) -> Counter:
+    padded = _padded(text)
+    return Counter({
+        topic: sum(1 for phrase in phrases if phrase in padded)
+        for topic, phrases in SEED_PHRASES.items()
+        if any(phrase in padded for phrase in phrases)
+    })
+
+def _describing_text(metadata: Dict) -> str:
+    # What a chunk is about: its file's tags, its headers and the file name
+    source = os.path.splitext(os.path.basename(metadata.get("source", "")))[0]
+    return " ".join([
+        metadata.get("tags", ""), metadata.get("Section", ""), metadata.get("Subsection", ""),
+        source.replace("_", " ").replace("-", " ")
+    ])
+
+def chunk_topics(metadata: Dict) -> List[str]:
+    """
+        The topics of a chunk, from the metadata extracted by process_immigration_doc.
+    """
+    return sorted(_matched_phrases(_describing_text(metadata))) or [GENERAL_TOPIC]
+
+def topic_metadata(metadata: Dict) -> Dict[str, bool]:
+    """
+        Boolean topic_<topic> fields for a chunk. Chroma filters can't look inside lists or
+        the comma-separated tags, but they can match these.
+    """
+    return {topic_field(topic): True for topic in chunk_topics(metadata)}
+
+def topic_where(topics: List[str]) -> Dict:
+    """
+        The Chroma where clause for chunks of any of the topics, general chunks included.
+    """
+    clauses = [{topic_field(topic): True} for topic in [*topics, GENERAL_TOPIC]]
+    return {"$or": clauses} if len(clauses) > 1 else clauses[0]
+
+class TopicIndex:
+    """
+        Maps questions to knowledge base topics so retrieval only searches their chunks.
+
+        Built at ingestion from the stored chunk metadata. A question matches a topic through
+        the seed phrases in TOPICS, or through terms learned from the tags and headers of the
+        topic's chunks (e.g. a tag like "Overseas Networks" on EP documents). When the matched
+        topics cover fewer than min_chunks chunks the filter is dropped, so a narrow topic
+        never starves the prompt.
+
+        Attributes:
+            schema (str) : the TOPIC_SCHEMA the chunks were tagged with.
+            counts (Dict[str, int]) : chunks per topic.
+            terms (Dict[str, Dict[str, int]]) : learned term -> {topic: chunks with the term}.
+    """
+    def __init__(self, schema: str, counts: Dict[str, int], terms: Dict[str, Dict[str, int]]):
+        self.schema = schema
+        self.counts = counts
+        self.terms = terms
+
+    @classmethod
+    def build(cls, metadatas: List[Dict]) -> "TopicIndex":
+        counts = Counter()
+        terms = defaultdict(Counter)
+        for metadata in metadatas:
+            metadata = metadata or {}
+            topics = [topic for topic in TOPICS if metadata.get(topic_field(topic))]
+            if not topics:
+                counts[GENERAL_TOPIC] += 1
+                continue
+            counts.update(topics)
+            for term in set(tokenize(_describing_text(metadata))):
+                if term[0].isdigit():
+                    continue
+                terms[term].update(topics)
+        # Only terms that point at one topic are worth keeping
+        learned = {
+            term: dict(topics) for term, topics in terms.items()
+            if max(topics.values()) / sum(topics.values()) >= LEARNED_TERM_PURITY and sum(topics.values()) >= 2
+        }
+        return cls(TOPIC_SCHEMA, dict(counts), learned)
+
+    def match(self, question: str) -> List[str]:
+        """
+            The topics a question is about, best first.
+        """
+        scores = Counter({topic: float(hits) for topic, hits in _matched_phrases(question).items()})
+        for term in set(tokenize(question)):
+            topics = self.terms.get(term)
+            if topics:
+                topic, count = max(topics.items(), key=lambda item: item[1])
+                scores[topic] += LEARNED_TERM_WEIGHT * count / sum(topics.values())
+        return [topic for topic, score in scores.most_common() if score >= 1.0]
+
+    def where(self, question: str, min_chunks: int = TOPIC_MIN_CHUNKS) -> Optional[Dict]:
+        """
+            The where clause restricting retrieval for the question, or None to search
+            everything: no topic matched, or the topics have too few chunks.
+        """
+        if not TOPIC_FILTER:
+            return None
+        topics = self.match(question)
+        if not topics:
+            return None
+        candidates = sum(self.counts.get(topic, 0) for topic in [*topics, GENERAL_TOPIC])
+        if candidates < min_chunks:
+            return None
+        return topic_where(topics)
+
+    def save(self, persist_dir: str):
+        path = os.path.join(persist_dir, TOPIC_INDEX_FILE)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"schema": self.schema, "counts": self.counts, "terms": self.terms}, f)
+        os.replace(tmp_path, path)
+
+def build_topic_index(vector_db, persist_dir: str) -> TopicIndex:
+    """
+        Rebuilds the topic index from the metadata of every chunk in the store and saves it in persist_dir.
+    """
+    metadatas = [metadata for page in iter_stored(vector_db, ["metadatas"]) for metadata in page["metadatas"]]
+    index = TopicIndex.build(metadatas)
+    index.save(persist_dir)
+    print(f"Topic index built: {index.counts}, {len(index.terms)} learned terms")
+    return index
+
+def load_topic_index(persist_dir: str) -> Optional[TopicIndex]:
+    """
+        Loads the topic index of an index version, or None if it has none or its chunks
+        were tagged with other topics.
+    """
+    path = os.path.join(persist_dir, TOPIC_INDEX_FILE)
+    if not os.path.exists(path):
+        print(f"No topic index in {persist_dir}, retrieval searches every chunk")
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if data["schema"] != TOPIC_SCHEMA:
+        print(f"Topic index in {persist_dir} is from other topics, retrieval searches every chunk")
+        return None
+    return TopicIndex(data["schema"], data["counts"], data["terms"])
+
+if __name__ == "__main__":
+    # Shows the topics and filter of a few questions against the current index version
+    from index_versions import current_index_dir
+
+    index = load_topic_index(current_index_dir())
+    if index is not None:
+        for question in [
+            "What are the salary requirements for an Employment Pass?",
+            "How do I incorporate a private limited company?",
+            "When do I need to register for GST?",
+            "Can I apply for PR after two years on an EP?",
+            "What does InCorp do?"
+        ]:
+            print(f"{question}\n  topics: {index.match(question)}, filter: {index.where(question)}")
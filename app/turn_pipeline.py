@@ -0,0 +1,181 @@
+import asyncio
+import os
+import time
+from typing import AsyncIterator, Awaitable, Callable, List, Dict, Optional, Set, Tuple
+from conversation_memory import format_summary
+from intent_router import route
+from lead_capture import LeadCapture, fast_extract
+from llm_gateway import OVERLOADED_ANSWER, LLMUnavailable
+from metrics import metrics
+from query_rewriter import rewrite_query
+from rag_pipeline import stream_answer
+
+# How long lead extraction may take, measured from the start of the turn.
+# Once the answer is done we wait at most for what's left of this budget, then the
+# extraction finishes in the background so it can never hold up the reply.
+EXTRACTION_TIMEOUT = float(os.getenv("LEAD_EXTRACTION_TIMEOUT", "3.0"))
+
+# Extractions that outlived their turn, kept so they aren't garbage collected before they're done
+_late_extractions: Set[asyncio.Task] = set()
+
+def format_chat_history(history: List[Dict]) -> str:
+    """
+        Formats the rolling history the same way for every frontend.
+    """
+    return "\n".join([f"User: {h['user']}\nAI: {h['ai']}" for h in history])
+
+async def _timed_extraction(lead_capture: LeadCapture, message: str, history: List[Dict]) -> bool:
+    with metrics.span("lead_extraction"):
+        return await lead_capture.extract_info_from_message(message, history)
+
+async def _finish_late(extraction: asyncio.Task, lead_capture: LeadCapture, captured_before: bool,
+                       on_late: Optional[Callable[[], Awaitable]]):
+    try:
+        updated = await extraction
+    except Exception as e:
+        print(f"Late lead extraction failed: {e}")
+        return
+    metrics.inc("late_extractions")
+    if lead_capture.info_captured and not captured_before:
+        metrics.inc("leads_captured")
+    if updated and on_late is not None:
+        await on_late()
+
+def _continue_extraction(extraction: asyncio.Task, lead_capture: LeadCapture, captured_before: bool,
+                         on_late: Optional[Callable[[], Awaitable]]):
+    """
+        Lets an extraction that didn't finish within its turn run to the end in the
+        background. It fills in lead_capture when it's done, so the details show up from
+        the next turn on, and on_late is called to store them.
+    """
+    task = asyncio.create_task(_finish_late(extraction, lead_capture, captured_before, on_late))
+    _late_extractions.add(task)
+    task.add_done_callback(_late_extractions.discard)
+
+async def _finish_extraction(extraction: asyncio.Task, deadline: float) -> Optional[bool]:
+    """
+        Waits for the lead extraction until the deadline.
+        Returns whether the lead info was updated, or None if it's still running.
+    """
+    remaining = deadline - time.monotonic()
+    try:
+        # Shielded so the timeout leaves the extraction running
+        return await asyncio.wait_for(asyncio.shield(extraction), timeout=max(remaining, 0))
+    except asyncio.TimeoutError:
+        print(f"Lead extraction exceeded {EXTRACTION_TIMEOUT}s, finishing it in the background")
+        return None
+
+def _is_cacheable(message: str, history: List[Dict], summary: str) -> bool:
+    """
+        Only answers that don't depend on the history or on personal details are cached.
+        Even a standalone question is answered with the history and summary in the prompt,
+        which carry what the user shared (nationality, salary, ...), so only the first
+        message of a conversation qualifies.
+    """
+    found, ambiguous = fast_extract(message)
+    if found or ambiguous:
+        return False
+    return not history and not summary
+
+async def run_turn(engine, lead_capture: LeadCapture, history: List[Dict], message: str,
+                   summary: str = "", on_late_extraction: Optional[Callable[[], Awaitable]] = None
+                   ) -> AsyncIterator[Tuple[str, str]]:
+    """
+        Runs one chat turn and yields (event, text) tuples as the answer streams.
+
+        Lead extraction and retrieval + generation run concurrently. Their results are
+        merged before the lead info request is appended, so should_request_info sees the
+        details shared in this very message just like when extraction ran first.
+
+        The decision-tree cases of the prompt (greetings, jobs, shared contact details and
+        unrelated questions) are answered by the intent router without retrieval. Questions
+        that open a conversation are answered from the engine's semantic answer cache when possible.
+        Fallback answers and turns where personal info was shared are never cached.
+        When the llm gateway can't serve the answer, an apology is streamed instead.
+        An extraction that misses EXTRACTION_TIMEOUT (e.g. queued behind answers in the
+        gateway) isn't cancelled, it finishes in the background and counts from the next turn.
+
+        Args:
+            engine: the shared RAGEngine.
+            lead_capture: the session's LeadCapture.
+            history: the session's rolling history (not modified here).
+            message: the user's message.
+            summary: the summary of the turns before the history (see conversation_memory).
+            on_late_extraction: optional coroutine function called when an extraction that
+                finished after its turn updated the lead info, e.g. to store it.
+    """
+    turn_start = time.monotonic()
+    deadline = turn_start + EXTRACTION_TIMEOUT
+    extraction = asyncio.create_task(_timed_extraction(lead_capture, message, history))
+    captured_before = lead_capture.info_captured
+    metrics.inc("turns")
+
+    try:
+        # Increment question counter
+        lead_capture.increment_question()
+
+        # The history only goes to the prompt, retrieval gets a standalone question
+        chat_history = format_summary(summary) + format_chat_history(history)
+
+        # Greetings, job queries, bare contact details and off-topic messages get their
+        # canned answer without retrieval or an llm call
+        with metrics.span("route"):
+            routed = route(message)
+
+        # Look the question up in the answer cache
+        cache = engine.answer_cache
+        cacheable = routed is None and cache is not None and _is_cacheable(message, history, summary)
+        cached = None
+        if cacheable:
+            with metrics.span("cache_lookup"):
+                vector = await engine.embeddings.aembed_query(message)
+                cached = cache.lookup(vector)
+
+        answer = ""
+        fell_back = False
+        if routed is not None:
+            answer = routed
+            yield "token", routed
+        elif cached is not None:
+            answer = cached
+            yield "token", cached
+        else:
+            # Stream the response (falls back to the fallback llm on <SERVICE_FALLBACK>)
+            # Retrieved up front so the scores can predict a fallback (see FALLBACK_MODE)
+            with metrics.span("query_rewrite"):
+                retrieval_query = await rewrite_query(message, history, engine.llm)
+            with metrics.span("retrieval"):
+                documents = await engine.retriever.ainvoke(retrieval_query)
+            try:
+                async for event, text in stream_answer(engine.rag_chain, engine.llm, message, chat_history,
+                                                       retrieval_query, documents):
+                    if event == "fallback":
+                        fell_back = True
+                        continue
+                    answer = "" if event == "reset" else answer + text
+                    yield event, text
+            except LLMUnavailable as e:
+                # The llm gateway is saturated or the provider keeps failing, answer
+                # with an apology instead of an error. It's never cached.
+                print(f"Degraded answer: {e}")
+                metrics.inc("degraded_answers")
+                fell_back = True
+                text = f"\n\n{OVERLOADED_ANSWER}" if answer else OVERLOADED_ANSWER
+                answer += text
+                yield "token", text
+
+        # Merge the lead extraction before deciding on the lead info request
+        with metrics.span("extraction_wait"):
+            info_updated = await _finish_extraction(extraction, deadline)
+        if lead_capture.info_captured and not captured_before:
+            metrics.inc("leads_captured")
+        if cacheable and cached is None and answer and not fell_back and info_updated is False:
+            cache.store(message, vector, answer)
+        if lead_capture.should_request_info():
+            yield "token", lead_capture.get_info_request_message()
+    finally:
+        # Timed out, or the client went away or the answer failed: the extraction still
+        # finishes so the details the user shared aren't lost
+        if not extraction.done():
+            _continue_extraction(extraction, lead_capture, captured_before, on_late_extraction)
+        metrics.observe("turn", time.monotonic() - turn_start)
@@ -0,0 +1,33 @@
+-- Moves chat transcripts from the chats.chat JSONB column to the append-only
+-- chat_messages table. Safe to run more than once.
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS chat_messages
+(
+    chat_id varchar NOT NULL REFERENCES chats (id) ON DELETE CASCADE,
+    turn_index integer NOT NULL,
+    user_message text NOT NULL,
+    ai_message text NOT NULL,
+    created_at timestamptz DEFAULT now(),
+    PRIMARY KEY (chat_id, turn_index)
+);
+
+-- New lead rows no longer carry the transcript
+ALTER TABLE chats ALTER COLUMN chat DROP NOT NULL;
+
+-- Old entries use the "users" key, fall back to "user" just in case
+INSERT INTO chat_messages (chat_id, turn_index, user_message, ai_message, created_at)
+SELECT c.id,
+       m.ordinality - 1,
+       COALESCE(m.value ->> 'users', m.value ->> 'user', ''),
+       COALESCE(m.value ->> 'ai', ''),
+       c.last_updated
+FROM chats c
+CROSS JOIN LATERAL jsonb_array_elements(c.chat) WITH ORDINALITY AS m(value, ordinality)
+WHERE c.chat IS NOT NULL AND jsonb_typeof(c.chat) = 'array'
+ON CONFLICT (chat_id, turn_index) DO NOTHING;
+
+-- Once the migrated transcripts are verified the old column can be cleared:
+-- UPDATE chats SET chat = NULL;
+
+COMMIT;
@@ -0,0 +1,7 @@
+-- Session state shared by all bot_api workers when SESSION_BACKEND=postgres
+CREATE TABLE IF NOT EXISTS chat_sessions
+(
+    id varchar PRIMARY KEY,
+    state jsonb NOT NULL,
+    updated_at timestamptz DEFAULT now()
+);
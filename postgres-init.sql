@@ -8,5 +8,23 @@ CREATE TABLE chats
     sentiment numeric NULL,
     last_updated timestamptz DEFAULT now(),
     created_at timestamptz DEFAULT now(),
-    chat jsonb NOT NULL
+    -- Legacy full transcript, new messages are stored in chat_messages
+    chat jsonb NULL
+);
+
+CREATE TABLE chat_messages
+(
+    chat_id varchar NOT NULL REFERENCES chats (id) ON DELETE CASCADE,
+    turn_index integer NOT NULL,
+    user_message text NOT NULL,
+    ai_message text NOT NULL,
+    created_at timestamptz DEFAULT now(),
+    PRIMARY KEY (chat_id, turn_index)
+);
+
+CREATE TABLE chat_sessions
+(
+    id varchar PRIMARY KEY,
+    state jsonb NOT NULL,
+    updated_at timestamptz DEFAULT now()
 );